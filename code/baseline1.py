@@ -1,18 +1,15 @@
 import os
 import json
-from transformers import AutoTokenizer, AutoModel
-
-# 设置模型和分词器路径
-MODEL_PATH = os.environ.get('MODEL_PATH', '/root/autodl-tmp/glm-4-9b-chat')
-TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", MODEL_PATH)
-
-# 加载分词器和模型
-tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, trust_remote_code=True)
-model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, device_map="auto").eval()
+from llm_backend import get_backend, BATCH_SIZE, LABEL_SCORING, LABEL_SCORING_ID
+from record_io import RecordWriter, RecordIndex, load_records, fingerprint
+from claim_store import iter_claims, render_prompt
+from instrumentation import span
 
 # 文件路径
 weibo_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json")
 baseline_output_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/baseline_results.json")
+# 逐条预测结果以 JSONL 追加写入，中断后可从检查点继续
+baseline_records_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/baseline_results.jsonl")
 
 # Prompt 模板
 baseline_prompt_template = '''
@@ -21,25 +18,46 @@ Based on the following statement:
 Is the statement true (1) or false (0)? Please respond with only 1 or 0.
 '''
 
-def generate_response(prompt):
-    """调用 LLM 生成响应"""
-    inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512).to(model.device)
-
-    outputs = model.generate(**inputs, max_new_tokens=16, do_sample=False)
-    response = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-
-    # 去掉原始 prompt 内容
-    response_without_prompt = response.replace(prompt.strip(), "").strip()
-
+def parse_prediction(response):
+    """从模型响应中解析 1/0 标签"""
     # 检查去掉 prompt 后的响应中是否包含 '1' 或 '0'
-    if '1' in response_without_prompt:
+    if '1' in response:
         return 1
-    elif '0' in response_without_prompt:
+    elif '0' in response:
         return 0
     else:
-        raise ValueError(f"Invalid response: {response_without_prompt}")
+        raise ValueError(f"Invalid response: {response}")
 
-def baseline_classification(weibo_file, baseline_output_file):
+def generate_responses(prompts):
+    """批量调用 LLM 生成响应，返回去掉 prompt 后的文本"""
+    return [response.strip() for response in get_backend().generate_batch(prompts, max_new_tokens=16, max_length=512)]
+
+def classify_prompts(prompts):
+    """
+    批量预测，返回 (标签, 置信度) 列表，无效响应的标签为 -1。
+    logit 模式下单次前向比较 '1' 与 '0' 的概率；generate 模式下生成文本后匹配，置信度为 None。
+    """
+    if LABEL_SCORING == "logit":
+        return [(int(label), confidence) for label, confidence in get_backend().score_labels(prompts, ["1", "0"], max_length=512)]
+
+    predictions = []
+    for response in generate_responses(prompts):
+        try:
+            predictions.append((parse_prediction(response), None))
+        except ValueError:
+            print(f"Invalid response: {response}")
+            predictions.append((-1, None))  # 无效响应
+    return predictions
+
+def baseline_fingerprint(entry):
+    """基线预测的输入指纹：声明、标签、prompt 模板、模型和打分方式"""
+    return fingerprint(entry["Claim"], entry["Label"], baseline_prompt_template, get_backend().model_id, LABEL_SCORING_ID)
+
+def generate_response(prompt):
+    """调用 LLM 生成响应"""
+    return parse_prediction(generate_responses([prompt])[0])
+
+def baseline_classification(weibo_file, baseline_output_file, baseline_records_file=baseline_records_file):
     """
     使用 baseline 方法对 weibo.json 中的声明进行预测，并计算准确率。
     """
@@ -47,11 +65,39 @@ def baseline_classification(weibo_file, baseline_output_file):
         print(f"{weibo_file} does not exist.")
         return
 
-    # 读取 weibo.json 文件
-    with open(weibo_file, 'r', encoding='utf-8') as f:
-        weibo_data = json.load(f)
-
-    baseline_results = []
+    # 读取 weibo.json 文件（有预处理的声明存储时直接从存储读取）
+    weibo_data = list(iter_claims(weibo_file))
+
+    # 按批次遍历 weibo 数据，逐条预测结果追加写入 JSONL，跳过输入指纹没有变化的 ID
+    with RecordWriter(baseline_records_file) as writer:
+        index = RecordIndex(baseline_records_file)
+        pending = [entry for entry in weibo_data if not index.is_current(entry["id"], baseline_fingerprint(entry))]
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = pending[start:start + BATCH_SIZE]
+
+            # 构造 Prompt
+            prompts = [render_prompt(baseline_prompt_template, {"{claim}": entry["Claim"]}) for entry in batch]
+            print(f"Processing IDs {batch[0]['id']}-{batch[-1]['id']}")
+
+            # 调用模型批量预测标签
+            with span("baseline", [entry["id"] for entry in batch]):
+                predictions = classify_prompts(prompts)
+
+            for entry, (prediction, confidence) in zip(batch, predictions):
+                true_label = int(entry["Label"])  # 转为整数
+
+                # 保存每条记录的结果
+                writer.write({
+                    "id": entry["id"],
+                    "claim": entry["Claim"],
+                    "true_label": true_label,
+                    "predicted_label": prediction,
+                    "confidence": confidence,
+                    "correct": prediction == true_label,
+                    "fingerprint": baseline_fingerprint(entry)
+                })
+
+    baseline_results = load_records(baseline_records_file)
     total = 0
     correct = 0
     true_correct = 0
@@ -59,25 +105,10 @@ def baseline_classification(weibo_file, baseline_output_file):
     true_total = 0
     false_total = 0
 
-    # 遍历 weibo 数据
-    for entry in weibo_data:
-        claim_id = entry["id"]
-        claim = entry["Claim"]
-        true_label = int(entry["Label"])  # 转为整数
-
-        # 构造 Prompt
-        prompt = baseline_prompt_template.replace("{claim}", claim)
-        print(f"Processing ID {claim_id}")
-
-        # 调用模型生成预测标签
-        try:
-            prediction = generate_response(prompt)
-            prediction = int(prediction)  # 转为整数
-        except ValueError:
-            print(f"Invalid response for ID {claim_id}: {prediction}")
-            prediction = -1  # 无效响应
-
-        # 更新统计信息
+    # 更新统计信息
+    for record in baseline_results:
+        prediction = record["predicted_label"]
+        true_label = record["true_label"]
         total += 1
         if prediction == true_label:
             correct += 1
@@ -91,15 +122,6 @@ def baseline_classification(weibo_file, baseline_output_file):
         elif true_label == 0:
             false_total += 1
 
-        # 保存每条记录的结果
-        baseline_results.append({
-            "id": claim_id,
-            "claim": claim,
-            "true_label": true_label,
-            "predicted_label": prediction,
-            "correct": prediction == true_label
-        })
-
     # 计算准确率
     total_accuracy = correct / total if total > 0 else 0
     true_accuracy = true_correct / true_total if true_total > 0 else 0
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import argparse
+import threading
+import collections
+import concurrent.futures
+from llm_backend import record_call, add_to_call
+
+# 启用调度器：各处的 generate_batch / score_labels 调用先进入调度队列，按长度分桶后再交给后端
+LLM_SCHEDULER = os.environ.get("LLM_SCHEDULER", "0") == "1"
+# 每个批次补齐后的 token 上限（行数 × 批次内最长 prompt 的 token 数）
+MAX_BATCH_TOKENS = int(os.environ.get("LLM_MAX_BATCH_TOKENS", "4096"))
+# 未凑满的批次最多等待的时间（秒）
+MAX_QUEUE_DELAY = float(os.environ.get("LLM_MAX_QUEUE_DELAY", "0.01"))
+# 最近多少个批次的统计保留在 batch_log 中
+BATCH_LOG_SIZE = 1000
+
+
+class _Request:
+    __slots__ = ("prompt", "length", "max_new_tokens", "future", "enqueued", "timing")
+
+    def __init__(self, prompt, length, max_new_tokens):
+        self.prompt = prompt
+        self.length = length
+        self.max_new_tokens = max_new_tokens
+        self.future = concurrent.futures.Future()
+        self.enqueued = time.monotonic()
+        self.timing = None  # (排队时间, 所在批次的调用记录, 批次行数)
+
+
+def pack_batches(requests, max_batch_tokens, max_batch_size):
+    """
+    按 token 长度排序后贪心装箱：批次补齐后的 token 数（行数 × 最长长度）不超过 max_batch_tokens，
+    行数不超过 max_batch_size。长度相近的 prompt 落在同一批，补齐浪费最少。
+    """
+    batches, batch = [], []
+    for request in sorted(requests, key=lambda request: request.length):
+        width = max(request.length, 1)  # 已排序，新加入的总是最长的
+        if batch and ((len(batch) + 1) * width > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(request)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padding_ratio(lengths):
+    """批次中补齐 token 占补齐后总 token 的比例"""
+    padded = len(lengths) * max(lengths) if lengths else 0
+    return 1 - sum(lengths) / padded if padded else 0
+
+
+class BatchScheduler:
+    """
+    位于后端前面的长度分桶调度器。各线程的调用（Verify、Question、情感叙事分类、基线等）进入同一队列，
+    参数相同的请求按 prompt 长度装箱：装满的批次立即交给后端，没装满的批次最多等待 max_delay 秒。
+    每个批次的行数、最长长度和补齐比例记录在 batch_log 中。
+    """
+
+    def __init__(self, backend, max_batch_tokens=MAX_BATCH_TOKENS, max_delay=MAX_QUEUE_DELAY, max_batch_size=None):
+        self.backend = backend
+        self.max_batch_tokens = max_batch_tokens
+        self.max_delay = max_delay
+        self.max_batch_size = max_batch_size or backend.batch_size
+        self.queues = collections.defaultdict(list)  # 调用参数 -> 等待中的请求
+        self.batch_log = collections.deque(maxlen=BATCH_LOG_SIZE)
+        self.totals = {"batches": 0, "prompts": 0, "prompt_tokens": 0, "padded_tokens": 0}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def generate_batch(self, prompts, max_new_tokens=16, do_sample=False, temperature=None, max_length=512, stop=None):
+        if isinstance(max_new_tokens, int):
+            max_new_tokens = [max_new_tokens] * len(prompts)
+        key = ("generate", do_sample, temperature, max_length, tuple(stop) if stop else None)
+        return self._submit(key, prompts, max_new_tokens, max_length)
+
+    def score_labels(self, prompts, candidates, max_length=512):
+        key = ("score", tuple(candidates), max_length)
+        return self._submit(key, prompts, [None] * len(prompts), max_length)
+
+    def _submit(self, key, prompts, limits, max_length):
+        """把请求放入队列并等待结果"""
+        if not prompts:
+            return []
+        requests = [_Request(prompt, min(self.backend.count_tokens(prompt), max_length), limit)
+                    for prompt, limit in zip(prompts, limits)]
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._thread.start()
+            self.queues[key].extend(requests)
+            self._condition.notify()
+        results = [request.future.result() for request in requests]
+        self._attribute(requests)
+        return results
+
+    @staticmethod
+    def _attribute(requests):
+        """
+        把调度线程中各批次的耗时和 token 数计入调用方线程正在记录的调用（见 instrumentation.py）：
+        排队时间取最长的一条，同一批次的预填充和解码时间只计一次，生成 token 按本调用占批次的行数分摊。
+        """
+        batches = collections.Counter(id(request.timing[1]) for request in requests)
+        records = {id(request.timing[1]): request.timing[1:] for request in requests}
+        generated = sum(record["generated_tokens"] * batches[key] / rows for key, (record, rows) in records.items())
+        add_to_call(queue=max(request.timing[0] + request.timing[1]["queue"] for request in requests),
+                    prefill=sum(record["prefill"] for record, _ in records.values()),
+                    decode=sum(record["decode"] for record, _ in records.values()),
+                    prompt_tokens=sum(request.length for request in requests),
+                    generated_tokens=int(round(generated)))
+
+    def _take_ready(self):
+        """取出可以发出的批次；返回 (批次列表, 下一个未满批次到期前的等待时间)"""
+        now = time.monotonic()
+        ready, wait = [], None
+        for key in list(self.queues):
+            if not self.queues[key]:
+                del self.queues[key]
+                continue
+            batches = pack_batches(self.queues[key], self.max_batch_tokens, self.max_batch_size)
+            last = batches[-1]
+            # 除最后一批外都已装满；最后一批等到最早的请求超过 max_delay 再发出
+            deadline = min(request.enqueued for request in last) + self.max_delay
+            if deadline > now:
+                remaining = deadline - now
+                wait = remaining if wait is None else min(wait, remaining)
+                batches = batches[:-1]
+                self.queues[key] = last
+            else:
+                del self.queues[key]
+            ready.extend((key, batch) for batch in batches)
+        return ready, wait
+
+    def _run(self):
+        while True:
+            with self._condition:
+                ready, wait = self._take_ready()
+                while not ready:
+                    self._condition.wait(timeout=wait)
+                    ready, wait = self._take_ready()
+            for key, batch in ready:
+                self._dispatch(key, batch)
+
+    def _dispatch(self, key, batch):
+        prompts = [request.prompt for request in batch]
+        dispatched = time.monotonic()
+        with record_call() as record:
+            try:
+                if key[0] == "generate":
+                    _, do_sample, temperature, max_length, stop = key
+                    results = self.backend.generate_batch(prompts, max_new_tokens=[request.max_new_tokens for request in batch],
+                                                          do_sample=do_sample, temperature=temperature,
+                                                          max_length=max_length, stop=list(stop) if stop else None)
+                else:
+                    _, candidates, max_length = key
+                    results = self.backend.score_labels(prompts, list(candidates), max_length=max_length)
+            except Exception as e:
+                results = e
+        for request in batch:
+            request.timing = (dispatched - request.enqueued, record, len(batch))
+        if isinstance(results, Exception):
+            for request in batch:
+                request.future.set_exception(results)
+            return
+
+        lengths = [request.length for request in batch]
+        self._log_batch(key[0], lengths, time.monotonic() - min(request.enqueued for request in batch))
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+    def _log_batch(self, method, lengths, queue_delay):
+        ratio = padding_ratio(lengths)
+        self.batch_log.append({"method": method, "rows": len(lengths), "max_tokens": max(lengths),
+                               "padding_ratio": ratio, "queue_delay": queue_delay})
+        self.totals["batches"] += 1
+        self.totals["prompts"] += len(lengths)
+        self.totals["prompt_tokens"] += sum(lengths)
+        self.totals["padded_tokens"] += len(lengths) * max(lengths)
+
+    def report(self):
+        totals = self.totals
+        ratio = 1 - totals["prompt_tokens"] / totals["padded_tokens"] if totals["padded_tokens"] else 0
+        rows = totals["prompts"] / totals["batches"] if totals["batches"] else 0
+        return (f"Batch scheduler: {totals['batches']} batches, {rows:.1f} prompts per batch, "
+                f"{ratio:.1%} padding ({totals['padded_tokens']} padded tokens for {totals['prompt_tokens']} prompt tokens)")
+
+
+def compare_padding(input_file, limit=256):
+    """对前 limit 条声明的基线、情感和叙事 prompt，比较按到达顺序分批与按长度分桶调度的补齐比例"""
+    from llm_backend import StubBackend
+    from baseline1 import baseline_prompt_template
+    from Analyze_emo_and_nt import emotion_prompt_template, narrative_prompt_template
+
+    with open(input_file, 'r', encoding='utf-8') as f:
+        claims = [item["Claim"] for item in json.load(f)[:limit] if item.get("Claim")]
+    prompts = [template.replace("{claim}", claim) for claim in claims
+               for template in (baseline_prompt_template, emotion_prompt_template, narrative_prompt_template)]
+
+    backend = StubBackend()
+    lengths = [min(backend.count_tokens(prompt), 512) for prompt in prompts]
+    fifo = [lengths[start:start + backend.batch_size] for start in range(0, len(lengths), backend.batch_size)]
+    fifo_padded = sum(len(batch) * max(batch) for batch in fifo)
+    print(f"Arrival order: {len(fifo)} batches, {1 - sum(lengths) / fifo_padded:.1%} padding")
+
+    scheduler = BatchScheduler(backend)
+    scheduler.score_labels(prompts, ["1", "0"])
+    print(scheduler.report())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="比较按长度分桶调度前后的补齐比例")
+    parser.add_argument("--input", default=os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json"))
+    parser.add_argument("--limit", type=int, default=256)
+    args = parser.parse_args()
+
+    compare_padding(args.input, args.limit)
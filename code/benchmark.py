@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import subprocess
+import contextlib
+import multiprocessing
+
+# 文件路径
+input_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json")
+work_root = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/benchmark")  # 各切片的中间文件和日志
+benchmark_output_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/benchmark_results.json")
+
+# 按执行顺序排列的阶段；每个阶段在单独的进程中运行，峰值内存互不影响
+BENCHMARK_STAGES = ["generate", "analyze", "execute", "score", "baseline", "metrics"]
+STAGE_FILES = {
+    "input": "weibo.json",
+    "generate": "execute_program.jsonl",
+    "analyze": "emotion_narrative_analysis.jsonl",
+    "execute": "result.jsonl",
+    "score": "result_count.jsonl",
+    "baseline": "baseline_results.jsonl",
+    "baseline_summary": "baseline_results.json",
+    "metrics": "accuracy_comparison.json",
+    "propagators": "potential_propagators.json",
+}
+
+
+def run_benchmark_stage(stage, work_dir):
+    """
+    在当前进程中运行一个阶段，返回耗时、后端计数器和峰值内存。
+    由 spawn 启动的子进程调用：各脚本在这里才导入，环境变量（后端类型、模拟延迟等）已经由父进程设置好。
+    """
+    paths = {name: os.path.join(work_dir, filename) for name, filename in STAGE_FILES.items()}
+    with open(os.path.join(work_dir, f"{stage}.log"), 'w', encoding='utf-8') as log, contextlib.redirect_stdout(log):
+        start = time.perf_counter()
+        if stage == "generate":
+            from sharded_runner import load_generator
+            load_generator().generate_programs(paths["input"], paths["generate"])
+        elif stage == "analyze":
+            from Analyze_emo_and_nt import analyze_emotion_and_narrative
+            analyze_emotion_and_narrative(paths["generate"], paths["analyze"])
+        elif stage == "execute":
+            from program_execution import execute_programs
+            execute_programs(paths["generate"], paths["analyze"], paths["execute"])
+        elif stage == "score":
+            from fact_scoring import score_results
+            score_results(paths["execute"], paths["score"])
+        elif stage == "baseline":
+            from baseline1 import baseline_classification
+            baseline_classification(paths["input"], paths["baseline_summary"], paths["baseline"])
+        elif stage == "metrics":
+            import getlabel
+            # getlabel 从模块级路径读取情感文件、写出传播源文件
+            getlabel.emotion_file = paths["analyze"]
+            getlabel.potential_propagators_file = paths["propagators"]
+            getlabel.calculate_metrics(paths["score"], paths["input"], paths["metrics"])
+        else:
+            raise ValueError(f"Unknown stage: {stage}")
+        elapsed = time.perf_counter() - start
+
+    result = {"elapsed": elapsed, "backend": {}, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    # 不调用模型的阶段不创建后端
+    import llm_backend
+    if llm_backend._backend is not None:
+        backend = llm_backend._backend
+        result["backend"] = dict(backend.stats)
+        if hasattr(backend, "cache"):
+            result["backend"]["cache_hits"] = backend.cache.hits
+            result["backend"]["cache_misses"] = backend.cache.misses
+    return result
+
+
+def summarize_stage(result, claims):
+    """把阶段的原始计数换算成每条声明的指标"""
+    stats = result["backend"]
+    per_claim = lambda value: value / claims if claims else 0
+    summary = {
+        "elapsed": result["elapsed"],
+        "claims_per_second": claims / result["elapsed"] if result["elapsed"] > 0 else 0,
+        "llm_calls_per_claim": per_claim(stats.get("calls", 0)),
+        "prompt_tokens_per_claim": per_claim(stats.get("prompt_tokens", 0)),
+        "prefill_tokens_per_claim": per_claim(stats.get("prefill_tokens", 0)),
+        "generated_tokens_per_claim": per_claim(stats.get("generated_tokens", 0)),
+        "peak_rss_mb": result["peak_rss_mb"],
+    }
+    if "cache_hits" in stats:
+        summary["cache_hits"] = stats["cache_hits"]
+        summary["cache_misses"] = stats["cache_misses"]
+    return summary
+
+
+def write_slice(input_file, work_dir, offset, size, programs_file=None):
+    """
+    把数据集的 [offset, offset + size) 切片写入空的工作目录，返回其中有声明的条数。
+    给出 programs_file 时把其中属于该切片的程序记录作为生成阶段的输出一并写入。
+    """
+    with open(input_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)[offset:offset + size]
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    with open(os.path.join(work_dir, STAGE_FILES["input"]), 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    if programs_file:
+        from record_io import load_records
+
+        ids = {item["id"] for item in data if item.get("Claim")}
+        programs = [record for record in load_records(programs_file) if record["id"] in ids]
+        if len(programs) < len(ids):
+            print(f"Warning: {programs_file} has programs for {len(programs)} of {len(ids)} claims")
+        with open(os.path.join(work_dir, STAGE_FILES["generate"]), 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in programs)
+    return sum(1 for item in data if item.get("Claim"))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(input_file, work_root, sizes, offset=0, stages=BENCHMARK_STAGES, programs_file=None):
+    """
+    对每个切片大小从空的工作目录开始依次运行各阶段（每个阶段一个新进程，输出文件都是全新的），
+    返回每个阶段的吞吐量、每条声明的调用数和 token 数以及峰值内存。
+    给出 programs_file 时使用其中固定的程序，不运行生成阶段。
+    """
+    context = multiprocessing.get_context("spawn")
+    if programs_file:
+        stages = [stage for stage in stages if stage != "generate"]
+    runs = []
+    for size in sizes:
+        work_dir = os.path.join(work_root, f"slice_{offset}_{size}")
+        claims = write_slice(input_file, work_dir, offset, size, programs_file)
+        stages_summary = {}
+        for stage in stages:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_benchmark_stage, (stage, work_dir))
+            stages_summary[stage] = summarize_stage(result, claims)
+            print_stage(size, stage, stages_summary[stage])
+        runs.append({"offset": offset, "size": size, "claims": claims, "stages": stages_summary})
+    return runs
+
+
+def print_stage(size, stage, summary):
+    print(f"[{size}] {stage:<8} {summary['claims_per_second']:9.2f} claims/s | "
+          f"{summary['llm_calls_per_claim']:6.2f} calls/claim | "
+          f"{summary['prompt_tokens_per_claim']:8.1f} prompt tokens/claim | "
+          f"{summary['generated_tokens_per_claim']:7.1f} generated tokens/claim | "
+          f"peak RSS {summary['peak_rss_mb']:.0f} MB")
+
+
+def compare_results(current, previous):
+    """按切片大小和阶段对比两次基准测试的吞吐量"""
+    before = {(run["size"], stage): summary for run in previous["runs"] for stage, summary in run["stages"].items()}
+    print(f"Compared with {previous.get('commit') or 'previous run'} ({previous.get('timestamp')}):")
+    for run in current["runs"]:
+        for stage, summary in run["stages"].items():
+            old = before.get((run["size"], stage))
+            if not old or not old["claims_per_second"]:
+                continue
+            change = summary["claims_per_second"] / old["claims_per_second"] - 1
+            print(f"[{run['size']}] {stage:<8} {old['claims_per_second']:9.2f} -> "
+                  f"{summary['claims_per_second']:9.2f} claims/s ({change:+.1%})")
+
+
+if __name__ == "__main__":
+    # 例：python benchmark.py --sizes 20 100 --token-latency 0.002
+    #     python benchmark.py --recorded /root/LX/Generation/llm_cache.sqlite \
+    #         --programs /root/LX/Generation/execute_program.jsonl --sizes 100
+    parser = argparse.ArgumentParser(description="各阶段的吞吐量、调用数、token 数和峰值内存基准测试")
+    parser.add_argument("--input", default=input_file)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 100], help="切片大小（条）")
+    parser.add_argument("--offset", type=int, default=0, help="切片在数据集中的起始位置")
+    parser.add_argument("--stages", nargs="+", choices=BENCHMARK_STAGES, default=BENCHMARK_STAGES)
+    parser.add_argument("--prefill-latency", type=float, default=0.0, help="桩后端每个预填充 token 的模拟耗时（秒）")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="桩后端每个生成 token 的模拟耗时（秒）")
+    parser.add_argument("--recorded", help="回放该 LLM 响应缓存中真实模型的输出（使用副本，不写入原文件）")
+    parser.add_argument("--programs", help="使用该文件中真实模型生成的程序（execute_program.jsonl），不运行生成阶段；"
+                                           "程序生成是采样调用、不进入响应缓存，回放执行阶段时需要")
+    parser.add_argument("--work-root", default=work_root)
+    parser.add_argument("--output", default=benchmark_output_file)
+    parser.add_argument("--compare", help="与之前保存的基准测试结果对比")
+    args = parser.parse_args()
+
+    # 子进程继承这些环境变量，在导入 llm_backend 时生效
+    os.environ["STUB_PREFILL_LATENCY"] = str(args.prefill_latency)
+    os.environ["STUB_TOKEN_LATENCY"] = str(args.token_latency)
+    os.makedirs(args.work_root, exist_ok=True)
+    if args.recorded:
+        replay_cache = os.path.join(args.work_root, "recorded_cache.sqlite")
+        shutil.copyfile(args.recorded, replay_cache)
+        os.environ["LLM_BACKEND"] = "recorded"
+        os.environ["LLM_CACHE_PATH"] = replay_cache
+    else:
+        os.environ["LLM_BACKEND"] = "stub"
+        os.environ.pop("LLM_CACHE_PATH", None)  # 基准测试不应命中之前运行留下的缓存
+
+    settings = {name: os.environ.get(name) for name in
+                ["LLM_BACKEND", "LLM_BATCH_SIZE", "LABEL_SCORING", "LAZY_EVAL", "CONTINUOUS_BATCHING", "LLM_SCHEDULER",
+                 "CLAIM_STORE", "SELF_CONSISTENCY_SAMPLES", "STUB_PREFILL_LATENCY", "STUB_TOKEN_LATENCY"]}
+    settings["recorded"] = args.recorded
+    settings["programs"] = args.programs
+    if args.recorded and not args.programs:
+        print("Warning: program generation samples and is not recorded; without --programs the generate stage and "
+              "the Question/Verify calls in the execute stage are answered by the stub backend")
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "settings": settings,
+        "runs": run_benchmark(args.input, args.work_root, args.sizes, args.offset, args.stages, args.programs),
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved benchmark results to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_results(report, json.load(f))
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from llm_backend import get_backend, BATCH_SIZE, LABEL_SCORING_ID
+from record_io import RecordWriter, RecordIndex, load_records, fingerprint
+from claim_store import iter_claims, render_prompt
+from instrumentation import span
+from baseline1 import baseline_prompt_template, classify_prompts
+from Analyze_emo_and_nt import analysis_fingerprint
+from program_execution import LAZY_EVAL
+from sharded_runner import load_generator
+
+# 文件路径
+input_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json")
+cascade_output_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/cascade_results.jsonl")
+cascade_sweep_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/cascade_sweep.json")
+
+# 基线置信度低于该阈值的声明才进入程序生成和执行
+CASCADE_THRESHOLD = float(os.environ.get("CASCADE_THRESHOLD", "0.8"))
+# 扫描的阈值：0 表示只用基线，1 表示几乎全部升级
+SWEEP_THRESHOLDS = [0.0, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.0]
+
+
+def needs_escalation(label, confidence, threshold):
+    """无效响应、没有置信度（generate 打分方式）或置信度低于阈值时升级到完整流程"""
+    return label == -1 or confidence is None or confidence < threshold
+
+
+def baseline_predictions(claims, ids):
+    """基线分类：每条声明一次调用，返回 (标签, 置信度) 列表"""
+    with span("cascade_baseline", list(ids)):
+        return classify_prompts([render_prompt(baseline_prompt_template, {"{claim}": claim}) for claim in claims])
+
+
+def program_verdicts(claims, ids):
+    """完整的程序生成、情感叙事分析、执行和打分流程"""
+    from service import check_claims
+    return check_claims(list(claims), list(ids))
+
+
+def cascade_batch(claims, ids, threshold=CASCADE_THRESHOLD):
+    """
+    对一批声明先运行基线分类，只把需要升级的声明交给完整流程。
+
+    返回：
+        list[dict]: 与 claims 一一对应的结论，escalated 表示是否走了完整流程
+    """
+    predictions = baseline_predictions(claims, ids)
+    escalated = [k for k, (label, confidence) in enumerate(predictions) if needs_escalation(label, confidence, threshold)]
+    verdicts = [{"claim": claim, "label": label, "baseline_label": label, "baseline_confidence": confidence,
+                 "escalated": False}
+                for claim, (label, confidence) in zip(claims, predictions)]
+    if escalated:
+        for k, verdict in zip(escalated, program_verdicts([claims[k] for k in escalated], [ids[k] for k in escalated])):
+            verdicts[k] = {**verdict, "baseline_label": predictions[k][0], "baseline_confidence": predictions[k][1],
+                           "escalated": True}
+    return verdicts
+
+
+def cascade_fingerprint(claim, threshold):
+    """级联结果的输入指纹：阈值、基线的 prompt 与打分方式，以及完整流程各阶段的输入"""
+    return fingerprint(claim, threshold, baseline_prompt_template, LABEL_SCORING_ID, get_backend().model_id,
+                       load_generator().program_fingerprint(claim), analysis_fingerprint(claim), LAZY_EVAL)
+
+
+def accuracy(predictions, truth):
+    known = truth >= 0
+    return float((predictions[known] == truth[known]).mean()) if known.any() else 0
+
+
+def run_cascade(input_file, output_file, threshold=CASCADE_THRESHOLD):
+    """对数据集运行级联，逐条写出结论，报告升级比例、准确率和吞吐量"""
+    backend = get_backend()
+    before = dict(backend.stats)
+    start = time.time()
+    with RecordWriter(output_file) as writer:
+        index = RecordIndex(output_file)
+        pending = [(item["id"], item["Claim"]) for item in iter_claims(input_file)
+                   if item.get("Claim") and not index.is_current(item["id"], cascade_fingerprint(item["Claim"], threshold))]
+        for start_index in range(0, len(pending), BATCH_SIZE):
+            batch = pending[start_index:start_index + BATCH_SIZE]
+            ids = [news_id for news_id, _ in batch]
+            try:
+                verdicts = cascade_batch([claim for _, claim in batch], ids, threshold)
+            except Exception as e:
+                print(f"Error processing claim IDs {ids[0]}-{ids[-1]}: {e}")
+                continue
+            for news_id, verdict in zip(ids, verdicts):
+                writer.write({"id": news_id, **verdict, "threshold": threshold,
+                              "fingerprint": cascade_fingerprint(verdict["claim"], threshold)})
+            print(f"Processed IDs {ids[0]}-{ids[-1]}: {sum(v['escalated'] for v in verdicts)}/{len(batch)} escalated")
+    elapsed = time.time() - start
+
+    truth = {item["id"]: int(item["Label"]) for item in iter_claims(input_file) if item.get("Label") not in (None, "")}
+    records = load_records(output_file)
+    predictions = np.array([record["label"] for record in records])
+    labels = np.array([truth.get(record["id"], -1) for record in records])
+    escalated = sum(record["escalated"] for record in records)
+    calls = backend.stats["calls"] - before["calls"]
+    print(f"Threshold {threshold}: {escalated}/{len(records)} escalated ({escalated / len(records) if records else 0:.1%}), "
+          f"accuracy {accuracy(predictions, labels):.4f}")
+    print(f"Processed {len(pending)} claims in {elapsed:.1f}s ({len(pending) / elapsed if elapsed > 0 else 0:.2f} claims/s, "
+          f"{calls / len(pending) if pending else 0:.2f} LLM calls per claim)")
+
+
+def timed_path(function, entries):
+    """按批运行一条路径，返回结果以及每条声明的平均耗时和平均 LLM 调用数"""
+    backend = get_backend()
+    before = backend.stats["calls"]
+    start = time.time()
+    results = []
+    for start_index in range(0, len(entries), BATCH_SIZE):
+        batch = entries[start_index:start_index + BATCH_SIZE]
+        results.extend(function([item["Claim"] for item in batch], [item["id"] for item in batch]))
+    elapsed = time.time() - start
+    count = max(len(entries), 1)
+    return results, {"seconds_per_claim": elapsed / count, "calls_per_claim": (backend.stats["calls"] - before) / count}
+
+
+def sweep_cascade(input_file, sweep_output_file, thresholds=SWEEP_THRESHOLDS, limit=None):
+    """
+    对（前 limit 条）声明分别运行基线和完整流程各一次，再离线计算每个阈值下的升级比例、准确率，
+    以及按两条路径的实测平均开销估计的吞吐量，得到准确率与吞吐量的折中曲线。
+    """
+    entries = [item for item in iter_claims(input_file) if item.get("Claim") and item.get("Label") not in (None, "")]
+    entries = entries[:limit] if limit else entries
+    truth = np.array([int(item["Label"]) for item in entries])
+
+    predictions, baseline_cost = timed_path(baseline_predictions, entries)
+    verdicts, program_cost = timed_path(program_verdicts, entries)
+    baseline_labels = np.array([label for label, _ in predictions])
+    # 没有置信度的预测总是升级
+    confidences = np.array([-1.0 if label == -1 or confidence is None else confidence
+                            for label, confidence in predictions])
+    program_labels = np.array([verdict["label"] for verdict in verdicts])
+
+    curve = []
+    for threshold in thresholds:
+        escalated = confidences < threshold
+        fraction = float(escalated.mean()) if len(entries) else 0
+        seconds = baseline_cost["seconds_per_claim"] + fraction * program_cost["seconds_per_claim"]
+        curve.append({
+            "threshold": threshold,
+            "escalated_fraction": fraction,
+            "accuracy": accuracy(np.where(escalated, program_labels, baseline_labels), truth),
+            "llm_calls_per_claim": baseline_cost["calls_per_claim"] + fraction * program_cost["calls_per_claim"],
+            "claims_per_second": 1 / seconds if seconds > 0 else 0,
+        })
+
+    report = {
+        "claims": len(entries),
+        "baseline": {**baseline_cost, "accuracy": accuracy(baseline_labels, truth)},
+        "program": {**program_cost, "accuracy": accuracy(program_labels, truth)},
+        "curve": curve,
+    }
+    with open(sweep_output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Baseline only: accuracy {report['baseline']['accuracy']:.4f}, "
+          f"{baseline_cost['calls_per_claim']:.2f} calls/claim; program path only: accuracy "
+          f"{report['program']['accuracy']:.4f}, {program_cost['calls_per_claim']:.2f} calls/claim")
+    for point in curve:
+        print(f"threshold {point['threshold']:.2f}: {point['escalated_fraction']:6.1%} escalated, "
+              f"accuracy {point['accuracy']:.4f}, {point['llm_calls_per_claim']:5.2f} calls/claim, "
+              f"~{point['claims_per_second']:.2f} claims/s")
+    print(f"Sweep results saved to {sweep_output_file}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="置信度门控的级联：先用基线分类，不确定时才生成并执行程序")
+    parser.add_argument("--input", default=input_file)
+    parser.add_argument("--output", default=cascade_output_file)
+    parser.add_argument("--threshold", type=float, default=CASCADE_THRESHOLD)
+    parser.add_argument("--sweep", action="store_true", help="扫描阈值，输出准确率与吞吐量的折中曲线")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=SWEEP_THRESHOLDS)
+    parser.add_argument("--limit", type=int, help="扫描时只使用前 limit 条声明")
+    parser.add_argument("--sweep-output", default=cascade_sweep_file)
+    args = parser.parse_args()
+
+    if args.sweep:
+        sweep_cascade(args.input, args.sweep_output, args.thresholds, args.limit)
+    else:
+        run_cascade(args.input, args.output, args.threshold)
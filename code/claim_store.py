@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+import functools
+import numpy as np
+from llm_backend import TokenizedPrompt, get_backend
+from record_io import iter_records
+
+# 预处理后的声明存储目录；设置后各阶段从存储中读取声明，prompt 由缓存的 token id 拼接而成
+CLAIM_STORE = os.environ.get("CLAIM_STORE", "")
+
+# 存储目录中的文件
+META_FILE = "meta.json"
+ARRAYS = ["ids", "labels", "id_order", "text_offsets", "text_hashes", "hash_order", "token_offsets"]
+TEXT_FILE = "text.bin"
+TOKENS_FILE = "tokens.bin"
+TOKEN_DTYPE = np.int32
+
+
+def text_hash(text):
+    """声明文本的 64 位哈希，用于按文本查找"""
+    return int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "big")
+
+
+def source_signature(path):
+    """源文件的路径、大小和修改时间，源文件变化后存储不再对应"""
+    stat = os.stat(path)
+    return {"source": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def build_claim_store(input_file, store_dir, backend=None):
+    """
+    一次性预处理：把数据集中的声明 id、标签、原始文本（UTF-8 拼接，附偏移）和 token id（拼接，附偏移）
+    写成可以内存映射的数组。token id 由当前后端的分词器计算，不含特殊 token。
+    """
+    backend = backend or get_backend()
+    ids, labels, hashes = [], [], []
+    text_offsets, token_offsets = [0], [0]
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, TEXT_FILE), 'wb') as f_text, \
+            open(os.path.join(store_dir, TOKENS_FILE), 'wb') as f_tokens:
+        for item in iter_records(input_file):
+            claim = item.get("Claim") or ""  # 没有声明的条目也保留，由各阶段自行跳过
+            data = claim.encode("utf-8")
+            f_text.write(data)
+            tokens = np.asarray(backend.encode(claim), dtype=TOKEN_DTYPE)
+            f_tokens.write(tokens.tobytes())
+            ids.append(item["id"])
+            labels.append(int(item["Label"]) if item.get("Label") not in (None, "") else -1)
+            hashes.append(text_hash(claim))
+            text_offsets.append(text_offsets[-1] + len(data))
+            token_offsets.append(token_offsets[-1] + len(tokens))
+
+    arrays = {
+        "ids": np.asarray(ids, dtype=np.int64),
+        "labels": np.asarray(labels, dtype=np.int8),
+        "text_offsets": np.asarray(text_offsets, dtype=np.int64),
+        "token_offsets": np.asarray(token_offsets, dtype=np.int64),
+        "text_hashes": np.asarray(hashes, dtype=np.uint64),
+    }
+    # 按 id 和按文本哈希查找用的排序下标
+    arrays["id_order"] = np.argsort(arrays["ids"], kind="stable")
+    arrays["hash_order"] = np.argsort(arrays["text_hashes"], kind="stable")
+    for name in ARRAYS:
+        np.save(os.path.join(store_dir, name + ".npy"), arrays[name])
+    meta = {**source_signature(input_file), "count": len(ids), "model_id": backend.model_id,
+            "tokens": int(token_offsets[-1])}
+    with open(os.path.join(store_dir, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def _memmap(path, dtype):
+    # 空文件不能做内存映射
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class ClaimStore:
+    """
+    只读的声明存储：所有数组都以内存映射方式打开，按 id 或按文本查找不需要解析 JSON，
+    token id 以数组视图返回，不复制数据。
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(store_dir, name + ".npy"), mmap_mode='r'))
+        self.text = _memmap(os.path.join(store_dir, TEXT_FILE), np.uint8)
+        self.tokens = _memmap(os.path.join(store_dir, TOKENS_FILE), TOKEN_DTYPE)
+        self.sorted_ids = self.ids[self.id_order]
+        self.sorted_hashes = self.text_hashes[self.hash_order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def matches(self, input_file):
+        """存储是否由 input_file 的当前内容生成"""
+        try:
+            signature = source_signature(input_file)
+        except OSError:
+            return False
+        return all(self.meta.get(key) == value for key, value in signature.items())
+
+    def position(self, claim_id):
+        """id 在存储中的位置，不存在时返回 None"""
+        k = int(np.searchsorted(self.sorted_ids, claim_id))
+        if k < len(self.sorted_ids) and self.sorted_ids[k] == claim_id:
+            return int(self.id_order[k])
+        return None
+
+    def claim_text(self, pos):
+        return self.text[self.text_offsets[pos]:self.text_offsets[pos + 1]].tobytes().decode("utf-8")
+
+    def claim_tokens(self, pos):
+        return self.tokens[self.token_offsets[pos]:self.token_offsets[pos + 1]]
+
+    def record(self, pos):
+        label = int(self.labels[pos])
+        return {"id": int(self.ids[pos]), "Claim": self.claim_text(pos), "Label": str(label) if label >= 0 else None}
+
+    def get(self, claim_id):
+        pos = self.position(claim_id)
+        return None if pos is None else self.record(pos)
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield self.record(pos)
+
+    def tokens_for_text(self, text):
+        """按文本查找声明的 token id，文本不在存储中时返回 None"""
+        target = np.uint64(text_hash(text))
+        k = int(np.searchsorted(self.sorted_hashes, target))
+        data = text.encode("utf-8")
+        while k < len(self.sorted_hashes) and self.sorted_hashes[k] == target:
+            pos = int(self.hash_order[k])
+            if self.text[self.text_offsets[pos]:self.text_offsets[pos + 1]].tobytes() == data:
+                return self.claim_tokens(pos)
+            k += 1
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_claim_store():
+    """进程内共享的声明存储，未设置 CLAIM_STORE 时返回 None"""
+    if not CLAIM_STORE or not os.path.exists(os.path.join(CLAIM_STORE, META_FILE)):
+        return None
+    return ClaimStore(CLAIM_STORE)
+
+
+@functools.lru_cache(maxsize=None)
+def splicing_enabled():
+    """存储中的 token id 由当前模型的分词器生成时才拼接 token"""
+    store = get_claim_store()
+    if store is None:
+        return False
+    if store.meta.get("model_id") != get_backend().model_id:
+        print(f"Claim store {CLAIM_STORE} was tokenized for {store.meta.get('model_id')}, "
+              f"not {get_backend().model_id}; prompts will be tokenized as text")
+        return False
+    return True
+
+
+def iter_claims(input_file):
+    """
+    遍历数据集中的声明。存储由 input_file 的当前内容生成时直接从内存映射的数组中读取，
+    否则回退为解析 input_file。
+    """
+    store = get_claim_store()
+    if store is not None and store.matches(input_file):
+        return iter(store)
+    return iter_records(input_file)
+
+
+@functools.lru_cache(maxsize=4096)
+def _segment_ids(segment):
+    """模板中固定片段的 token id，每个片段只分词一次"""
+    return tuple(get_backend().encode(segment))
+
+
+def render_prompt(template, fields):
+    """
+    用 fields（占位符 -> 取值）一次性填充模板，文本结果与对每个占位符 str.replace 相同。
+    启用声明存储时，返回的 TokenizedPrompt 由模板固定片段的缓存 token id、
+    存储中声明的 token id 以及其余取值现场分词的 token id 拼接而成，后端不再对整段 prompt 分词。
+    在片段边界处分词可能与整段分词略有不同，因此只在设置 CLAIM_STORE 时启用。
+    """
+    if not fields:
+        return template
+    pattern = re.compile("|".join(re.escape(placeholder) for placeholder in fields))
+    pieces = pattern.split(template)
+    placeholders = pattern.findall(template)
+    text = pieces[0] + "".join(fields[placeholder] + piece for placeholder, piece in zip(placeholders, pieces[1:]))
+    if not splicing_enabled():
+        return text
+
+    store = get_claim_store()
+    token_ids = list(_segment_ids(pieces[0]))
+    for placeholder, piece in zip(placeholders, pieces[1:]):
+        value = fields[placeholder]
+        tokens = store.tokens_for_text(value)
+        token_ids.extend(tokens.tolist() if tokens is not None else _segment_ids(value))
+        token_ids.extend(_segment_ids(piece))
+    return TokenizedPrompt(text, token_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="预处理声明：写出内存映射的 id、文本偏移和 token id")
+    parser.add_argument("input", help="weibo.json")
+    parser.add_argument("store_dir")
+    args = parser.parse_args()
+
+    meta = build_claim_store(args.input, args.store_dir)
+    print(f"Stored {meta['count']} claims ({meta['tokens']} tokens, {meta['model_id']}) in {args.store_dir}")
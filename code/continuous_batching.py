@@ -0,0 +1,109 @@
+import os
+import time
+import argparse
+from llm_backend import get_backend, BATCH_SIZE
+
+# 文件路径
+input_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json")
+
+
+class ContinuousBatcher:
+    """
+    逐步（iteration-level）批处理的生成引擎：每个解码步之后，已生成出停止序列或达到长度上限的序列立即移出，
+    空出的位置马上由新的声明填上，批次始终保持满载。continuous 为 False 时退化为静态批处理：
+    只有整批都结束后才加入下一批，用于对比。
+    """
+
+    def __init__(self, prefix, max_batch_size=BATCH_SIZE, continuous=True, backend=None, **generation_params):
+        self.prefix = prefix
+        self.max_batch_size = max_batch_size
+        self.continuous = continuous
+        self.backend = backend or get_backend()
+        self.generation_params = generation_params
+        self.report = {}
+
+    def run(self, requests, on_finish=None):
+        """
+        参数：
+            requests (iterable): (key, suffix)，suffix 接在固定前缀之后构成完整 prompt。
+            on_finish (callable): 每条序列结束时立即以 (key, 生成文本) 调用。
+
+        返回：
+            dict: key -> 生成文本
+        """
+        batch = self.backend.decode_batch(self.prefix, **self.generation_params)
+        requests = iter(requests)
+        exhausted = False
+        results = {}
+        steps = 0
+        decoded_tokens = 0  # 各解码步中活跃序列数之和，即生成的 token 数
+        start = time.time()
+
+        while True:
+            # 有空位就加入新序列；静态批处理只在整批结束后才加入
+            if self.continuous or len(batch) == 0:
+                while not exhausted and len(batch) < self.max_batch_size:
+                    try:
+                        key, suffix = next(requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    batch.add(key, suffix)
+            if len(batch) == 0:
+                break
+
+            for key, text in batch.step():
+                results[key] = text
+                if on_finish is not None:
+                    on_finish(key, text)
+            if len(batch) > 0:
+                steps += 1
+                decoded_tokens += len(batch)
+
+        elapsed = time.time() - start
+        self.report = {
+            "mode": "continuous" if self.continuous else "static",
+            "sequences": len(results),
+            "decode_steps": steps,
+            "generated_tokens": decoded_tokens,
+            "elapsed": elapsed,
+            "tokens_per_second": decoded_tokens / elapsed if elapsed > 0 else 0,
+            "mean_occupancy": decoded_tokens / (steps * self.max_batch_size) if steps else 0,
+        }
+        return results
+
+
+def print_report(report):
+    print(f"[{report['mode']}] {report['sequences']} sequences, {report['decode_steps']} decode steps, "
+          f"{report['generated_tokens']} tokens in {report['elapsed']:.2f}s "
+          f"({report['tokens_per_second']:.1f} tokens/s), mean batch occupancy {report['mean_occupancy']:.1%}")
+
+
+def compare_batching(input_file, limit=64, max_batch_size=BATCH_SIZE):
+    """对前 limit 条声明分别用静态批处理和逐步批处理生成程序，比较吞吐量和批次占用率"""
+    import json
+    from sharded_runner import load_generator
+
+    generator = load_generator()
+    with open(input_file, 'r', encoding='utf-8') as f:
+        data = [item for item in json.load(f)[:limit] if item.get("Claim")]
+    requests = [(item["id"], generator.prompt_suffix_template.replace('[CLAIM]', item["Claim"])) for item in data]
+
+    reports = []
+    for continuous in (False, True):
+        batcher = ContinuousBatcher(generator.prompt_prefix, max_batch_size, continuous, **generator.GENERATION_PARAMS)
+        batcher.run(requests)
+        print_report(batcher.report)
+        reports.append(batcher.report)
+    return reports
+
+
+if __name__ == "__main__":
+    # 对比：STUB_STEP_LATENCY=0.01 LLM_BACKEND=stub python continuous_batching.py --limit 64
+    parser = argparse.ArgumentParser(description="比较静态批处理与逐步批处理的程序生成吞吐量")
+    parser.add_argument("--input", default=input_file)
+    parser.add_argument("--limit", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    compare_batching(args.input, args.limit, args.batch_size)
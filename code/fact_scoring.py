@@ -0,0 +1,75 @@
+import os
+import itertools
+from record_io import RecordWriter, RecordIndex, follow_records, fingerprint, record_hash
+from instrumentation import traced
+
+# 文件路径
+result_file = os.path.join(os.path.dirname(__file__), "result.jsonl")  # program_execution.py 的执行结果
+result_count_file = os.path.join(os.path.dirname(__file__), "result_count.jsonl")  # getlabel.py 读取的得分文件
+
+
+def score_fingerprint(result):
+    """得分只取决于执行结果的内容"""
+    return fingerprint(record_hash(result))
+
+
+@traced("score", lambda result: result["id"])
+def score_record(result):
+    """
+    统计一条执行结果中两轮 Verify 为 True 的 fact 数。
+
+    返回：
+        dict: {"id", "FactScore", "Fact_withScore", "all_num"}，all_num 为程序中的 fact 总数
+    """
+    basic_verification = result.get("basic_verification", {})
+    emotion_narrative_verification = result.get("emotion_narrative_verification", {})
+    return {
+        "id": result["id"],
+        "FactScore": sum(1 for label in basic_verification.values() if label == "True"),
+        "Fact_withScore": sum(1 for label in emotion_narrative_verification.values() if label == "True"),
+        # lazy 模式下被跳过的 fact 不计入得分，但仍计入总数
+        "all_num": result.get("num_facts", len(basic_verification)),
+        "fingerprint": score_fingerprint(result)
+    }
+
+
+def score_results(result_file, result_count_file, follow=False, poll_interval=1.0, idle_timeout=None):
+    """
+    读取执行结果并增量写出得分，执行结果没有变化的 id 会被跳过；
+    执行结果被重新计算（同一 id 追加了新记录）时重新打分。
+
+    follow 为 True 时持续跟踪 result_file 的追加写入，可以与 program_execution.py 同时运行，
+    getlabel.py 随时可以读取已写出的部分；idle_timeout 秒内没有新结果时结束。
+    """
+    with RecordWriter(result_count_file) as writer:
+        index = RecordIndex(result_count_file)
+        print(f"Existing records: {len(index)}")
+
+        # 先处理已有执行结果中每个 id 的最后一条，follow 模式下再从文件末尾继续跟踪新写入的结果
+        results = RecordIndex(result_file)
+        pending = results.latest_records()
+        if follow:
+            pending = itertools.chain(pending, follow_records(result_file, poll_interval, idle_timeout, results.end))
+
+        scored = 0
+        for result in pending:
+            if index.is_current(result["id"], score_fingerprint(result)):
+                continue
+            score = score_record(result)
+            index.add(score, writer.write(score))
+            scored += 1
+            print(f"Scored ID: {result['id']}")
+
+    print(f"Scored {scored} results into {result_count_file}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--follow", action="store_true", help="持续跟踪 result.jsonl，边执行边打分")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--idle-timeout", type=float, default=None, help="follow 模式下无新结果多少秒后退出")
+    args = parser.parse_args()
+
+    score_results(result_file, result_count_file, args.follow, args.poll_interval, args.idle_timeout)
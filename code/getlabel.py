@@ -1,210 +1,290 @@
 import os
 import json
+import numpy as np
+from record_io import load_records
 
 # 文件路径
-predicted_file = os.path.join(os.path.dirname(__file__), "result_count.json")  # 预测结果文件
+predicted_file = os.path.join(os.path.dirname(__file__), "result_count.jsonl")  # 预测结果文件
 ground_truth_file = os.path.join(os.path.dirname(__file__), "weibo.json")  # 正确答案文件
-emotion_file = os.path.join(os.path.dirname(__file__), "emotion_narrative_analysis.json")  # 情感文件
+emotion_file = os.path.join(os.path.dirname(__file__), "emotion_narrative_analysis.jsonl")  # 情感文件
 potential_propagators_file = os.path.join(os.path.dirname(__file__), "potential_propagators.json")  # 谣言传播源文件
 output_comparison_file = os.path.join(os.path.dirname(__file__), "accuracy_comparison.json")  # 对比输出文件
+sweep_output_file = os.path.join(os.path.dirname(__file__), "fusion_sweep.json")  # 参数扫描输出文件
 
 # 定义坏标签
 BAD_EMOTIONS = ["anger", "fear", "disgust"]
 BAD_NARRATIVE_TECHNIQUES = ["Exaggeration", "Inflammatory", "Fabrication"]
 
+# 输出到 accuracy_comparison.json 的指标
+METRIC_NAMES = ["OverallAccuracy", "Precision", "Recall", "F1_Score", "RealNewsAccuracy", "FakeNewsAccuracy"]
+# 参数扫描表中的指标：Precision/Recall/F1_Score 为真实新闻类，另加虚假新闻类的 P/R/F1 和两类的 Macro F1
+SWEEP_METRIC_NAMES = METRIC_NAMES + ["FakePrecision", "FakeRecall", "FakeF1_Score", "MacroF1"]
+
+# 参数扫描的默认网格
+SWEEP_ALPHAS = np.round(np.linspace(0, 1, 11), 2)
+SWEEP_BETAS = np.round(np.linspace(0, 1, 11), 2)
+SWEEP_THRESHOLDS = np.round(np.linspace(0.5, 1, 11), 2)
+# 比较融合得分与阈值时的容差，避免 0.7 + 0.3 之类的浮点误差
+SWEEP_EPSILON = 1e-9
+
+
+def id_lookup(ids, values, size, fill, dtype=None):
+    """按 id 建立查找数组 table[id] = value，重复的 id 以第一次出现的记录为准"""
+    table = np.full(size, fill, dtype=dtype)
+    if len(ids) > 0:
+        unique_ids, first = np.unique(np.asarray(ids, dtype=np.int64), return_index=True)
+        table[unique_ids] = np.asarray(values, dtype=dtype)[first]
+    return table
+
+
+def load_score_arrays(predicted_results):
+    """把预测结果中的 id、FactScore、Fact_withScore、all_num 读成数组"""
+    count = len(predicted_results)
+    ids = np.fromiter((entry["id"] for entry in predicted_results), dtype=np.int64, count=count)
+    fact_scores = np.fromiter((entry["FactScore"] for entry in predicted_results), dtype=np.float64, count=count)
+    fact_with_scores = np.fromiter((entry["Fact_withScore"] for entry in predicted_results), dtype=np.float64, count=count)
+    all_nums = np.fromiter((entry["all_num"] for entry in predicted_results), dtype=np.float64, count=count)
+    return ids, fact_scores, fact_with_scores, all_nums
+
+
+def fuse_labels(fact_scores, fact_with_scores, all_nums, alpha=0.5, beta=0.5):
+    """融合两轮验证的得分：alpha * 基础得分比例 + beta * 情感叙事得分比例 == 1 时判为真实新闻"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fused = alpha * (fact_scores / all_nums) + beta * (fact_with_scores / all_nums)
+    return (fused == 1).astype(np.int64)
+
+
+def confusion_metrics(predictions, ground_truth):
+    """
+    在最后一维上统计分类指标，predictions 可以带有额外的前置维度（如参数网格）。
+
+    返回：
+        dict: OverallAccuracy、真实新闻类的 Precision、Recall、F1_Score，虚假新闻类的 FakePrecision、FakeRecall、
+        FakeF1_Score，MacroF1、RealNewsAccuracy、FakeNewsAccuracy 以及各类计数
+    """
+    real = ground_truth == 1
+    fake = ground_truth == 0
+    true_positives = np.sum((predictions == 1) & real, axis=-1)
+    false_positives = np.sum((predictions == 1) & fake, axis=-1)
+    false_negatives = np.sum((predictions == 0) & real, axis=-1)
+    true_negatives = np.sum((predictions == 0) & fake, axis=-1)
+    total_real_news = np.sum(real)
+    total_fake_news = np.sum(fake)
+
+    def ratio(numerator, denominator):
+        numerator = np.asarray(numerator, dtype=np.float64)
+        return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=np.asarray(denominator) > 0)
+
+    precision = ratio(true_positives, true_positives + false_positives)
+    recall = ratio(true_positives, true_positives + false_negatives)
+    f1 = ratio(2 * precision * recall, precision + recall)
+    # 虚假新闻类：把预测为 0 看作正例
+    fake_precision = ratio(true_negatives, true_negatives + false_negatives)
+    fake_recall = ratio(true_negatives, true_negatives + false_positives)
+    fake_f1 = ratio(2 * fake_precision * fake_recall, fake_precision + fake_recall)
+    return {
+        "OverallAccuracy": ratio(true_positives + true_negatives, total_real_news + total_fake_news),
+        "Precision": precision,
+        "Recall": recall,
+        "F1_Score": f1,
+        "FakePrecision": fake_precision,
+        "FakeRecall": fake_recall,
+        "FakeF1_Score": fake_f1,
+        "MacroF1": (f1 + fake_f1) / 2,
+        "RealNewsAccuracy": ratio(true_positives, total_real_news),
+        "FakeNewsAccuracy": ratio(true_negatives, total_fake_news),
+        "TruePositives": true_positives,
+        "FalsePositives": false_positives,
+        "FalseNegatives": false_negatives,
+        "TrueNegatives": true_negatives,
+    }
+
 
 def calculate_metrics(predicted_file, ground_truth_file, output_comparison_file):
     """
     计算预测结果与正确答案的准确率、精确率、召回率和 F1 分数，并输出每条记录的对比结果。
+
+    预测、正确答案和情感叙事结果按 id 一次性对齐成数组，标签融合、指标和传播源筛选都是向量化计算。
     """
     if not os.path.exists(predicted_file) or not os.path.exists(ground_truth_file):
         print("One or both input files do not exist.")
         return
 
     # 读取文件内容
-    with open(predicted_file, 'r', encoding='utf-8') as f:
-        predicted_results = json.load(f)
+    predicted_results = load_records(predicted_file)  # JSONL 或 JSON 数组
 
     with open(ground_truth_file, 'r', encoding='utf-8') as f:
         ground_truth_data = json.load(f)
 
     # 读取情感文件内容
-    with open(emotion_file, 'r', encoding='utf-8') as f:
-        emotion_data = json.load(f)
-
-    # 构建 ground_truth 字典，便于查找
-    ground_truth_dict = {entry["id"]: entry["Label"] for entry in ground_truth_data}
-
-    # 初始化变量
-    correct_predictions = 0
-    total_predictions = 0
-    true_positives = 0
-    false_positives = 0
-    false_negatives = 0
-    correct_real_news = 0  # 真实新闻预测正确数量
-    total_real_news = 0    # 真实新闻总数量
-    correct_fake_news = 0  # 假新闻预测正确数量
-    total_fake_news = 0    # 假新闻总数量
-    fact_total_score = 0
-    fact_with_total_score = 0
-    total_num = 0
-    potential_propagators_count=0
-    fact_win=0
-    factwith_win=0
-
-
-    alpha=0.5
-    beta=0.5
-
-    c=0
-    comparison_results = []
-
-    potential_propagators = []  # 用于存储谣言传播源的列表
-
-    # 遍历预测结果
-    for entry in predicted_results:
-        entry_id = entry["id"]
-        fact_score = entry["FactScore"]
-        fact_with_score = entry["Fact_withScore"]
-        fact_total_score += fact_score
-        fact_with_total_score += fact_with_score
-        all_num = entry["all_num"]
-        total_num += all_num
-
-        
-
-        id = ground_truth_dict[entry_id]
-        
-
-        if(fact_score!=fact_with_score):
-            if(fact_score / all_num ==1):
-                fact_win+=1
-            elif(fact_with_score / all_num ==1):
-                if int(ground_truth_dict[entry_id]) == 1:
-                    #print("factwith win")
-                    factwith_win+=1
-        # 检查 all_num 是否为零
-        if all_num == 0:
-            print(f"Warning: all_num is zero for entry id {entry_id}. Skipping this entry.")
-            continue
-
-        
-        # if(fact_score!=fact_with_score): 
-        #                 print(f"id: {entry_id}, fact_score: {fact_score}, fact_with_score: {fact_with_score}, "
-        #           f"all_num: {all_num}, fact_score/all_num: {fact_score/all_num:.2f}, "
-        #           f"fact_with_score/all_num: {fact_with_score/all_num:.2f}")
-        #                 print(alpha * (fact_score/all_num) + beta * (fact_with_score/all_num))
-
-        #                 print()
-        
-
-        # 计算最终预测标签
-        if(alpha * (fact_score/all_num) + beta * (fact_with_score/all_num) ==1):
-            label_prediction = 1
-        else:
-            label_prediction = 0
-        
-        if label_prediction == 0:
-            # 查找与 entry_id 匹配的情感条目
-            emotion_entry = next((item for item in emotion_data if item["id"] == entry_id), None)
-            
-            if emotion_entry:
-                emotions = emotion_entry.get("emotion", "")
-                narrative_techniques = emotion_entry.get("narrative_techniques", "")
-                # print(emotions)
-                # print(narrative_techniques)
-                has_bad_emotion = emotions in BAD_EMOTIONS
-                has_bad_narrative = narrative_techniques in BAD_NARRATIVE_TECHNIQUES
-
-                if has_bad_emotion is True and has_bad_narrative is True:
-                    potential_propagators_count+=1
-                    potential_propagators.append({
-                        "id": entry_id,
-                        "Claim": ground_truth_data[entry_id - 1]["Claim"],
-                        "emotions": emotions,
-                        "narrative_techniques": narrative_techniques
-                    })
-                    
-
-            
-
-        # 获取正确答案
-        ground_truth_label = ground_truth_dict.get(entry_id, None)
-
-        # 比较预测与正确答案
-        if ground_truth_label is not None:
-            ground_truth_label = int(ground_truth_label)
-            is_correct = label_prediction == ground_truth_label
-            if is_correct:
-                correct_predictions += 1
-
-            # 分类统计真实新闻和假新闻
-            if ground_truth_label == 1:
-                total_real_news += 1
-                if is_correct:
-                    correct_real_news += 1
-            elif ground_truth_label == 0:
-                total_fake_news += 1
-                if is_correct:
-                    correct_fake_news += 1
-
-            # 统计分类指标
-            if label_prediction == 1 and ground_truth_label == 1:
-                true_positives += 1
-            elif label_prediction == 1 and ground_truth_label == 0:
-                false_positives += 1
-            elif label_prediction == 0 and ground_truth_label == 1:
-                false_negatives += 1
-
-            total_predictions += 1
-
-            # 保存对比结果
-            comparison_results.append({
-                "id": entry_id,
-                "Claim": ground_truth_data[entry_id - 1]["Claim"],
-                "PredictedLabel": label_prediction,
-                "GroundTruthLabel": ground_truth_label,
-                "Correct": is_correct
-            })
+    emotion_data = load_records(emotion_file) if os.path.exists(emotion_file) else []
+
+    ids, fact_scores, fact_with_scores, all_nums = load_score_arrays(predicted_results)
+    truth_ids = [entry["id"] for entry in ground_truth_data]
+    emotion_ids = [entry["id"] for entry in emotion_data]
+    size = max([0, *truth_ids, *emotion_ids, *ids.tolist()]) + 1
+
+    # 按 id 建立查找表：正确答案（-1 表示缺失）、在数据集中的位置、是否为坏情感与坏叙事
+    ground_truth_by_id = id_lookup(truth_ids, [int(entry["Label"]) for entry in ground_truth_data], size, -1, np.int64)
+    position_by_id = id_lookup(truth_ids, np.arange(len(ground_truth_data)), size, -1, np.int64)
+    bad_by_id = id_lookup(
+        emotion_ids,
+        [entry.get("emotion", "") in BAD_EMOTIONS and entry.get("narrative_techniques", "") in BAD_NARRATIVE_TECHNIQUES
+         for entry in emotion_data],
+        size, False, bool
+    )
+    emotion_position_by_id = id_lookup(emotion_ids, np.arange(len(emotion_data)), size, -1, np.int64)
+
+    # 检查 all_num 是否为零
+    for entry_id in ids[all_nums == 0]:
+        print(f"Warning: all_num is zero for entry id {entry_id}. Skipping this entry.")
+    scored = all_nums != 0
+
+    # 计算最终预测标签
+    alpha = 0.5
+    beta = 0.5
+    label_predictions = fuse_labels(fact_scores, fact_with_scores, all_nums, alpha, beta)
+
+    # 谣言传播源：判为虚假，且情感和叙事手法都属于坏标签
+    claims = [entry["Claim"] for entry in ground_truth_data]
+    propagator_ids = ids[scored & (label_predictions == 0) & bad_by_id[ids] & (position_by_id[ids] != -1)]
+    potential_propagators = []
+    for entry_id, position, emotion_position in zip(propagator_ids.tolist(), position_by_id[propagator_ids].tolist(),
+                                                    emotion_position_by_id[propagator_ids].tolist()):
+        emotion_entry = emotion_data[emotion_position]
+        potential_propagators.append({
+            "id": entry_id,
+            "Claim": claims[position],
+            "emotions": emotion_entry.get("emotion", ""),
+            "narrative_techniques": emotion_entry.get("narrative_techniques", "")
+        })
+
+    # 与正确答案比较
+    ground_truth_labels = ground_truth_by_id[ids]
+    compared = scored & (ground_truth_labels != -1)
+    predictions = label_predictions[compared]
+    truths = ground_truth_labels[compared]
+    metrics = {name: float(value) for name, value in confusion_metrics(predictions, truths).items()
+               if name in METRIC_NAMES}
+
+    positions = position_by_id[ids[compared]]
+    comparison_results = [
+        {
+            "id": entry_id,
+            "Claim": claims[position],
+            "PredictedLabel": prediction,
+            "GroundTruthLabel": truth,
+            "Correct": prediction == truth
+        }
+        for entry_id, position, prediction, truth in zip(ids[compared].tolist(), positions.tolist(),
+                                                         predictions.tolist(), truths.tolist())
+    ]
 
     # 保存谣言传播源到 potential_propagators.json 文件
+    # （json.dumps 一次性编码后整体写入，比 json.dump 逐片写文件快得多）
     with open(potential_propagators_file, 'w', encoding='utf-8') as f:
-        json.dump(potential_propagators, f, indent=2, ensure_ascii=False)
-
-    # 计算评价指标
-    accuracy = correct_predictions / total_predictions if total_predictions > 0 else 0
-    precision = true_positives / (true_positives + false_positives) if (true_positives + false_positives) > 0 else 0
-    recall = true_positives / (true_positives + false_negatives) if (true_positives + false_negatives) > 0 else 0
-    f1_score = (2 * precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-
-    # 计算真实新闻和假新闻的准确率
-    real_news_accuracy = correct_real_news / total_real_news if total_real_news > 0 else 0
-    fake_news_accuracy = correct_fake_news / total_fake_news if total_fake_news > 0 else 0
+        f.write(json.dumps(potential_propagators, indent=2, ensure_ascii=False))
 
     # 保存对比结果到文件
     with open(output_comparison_file, 'w', encoding='utf-8') as f:
-        json.dump({
+        f.write(json.dumps({
             "comparison_results": comparison_results,
-            "metrics": {
-                "OverallAccuracy": accuracy,
-                "Precision": precision,
-                "Recall": recall,
-                "F1_Score": f1_score,
-                "RealNewsAccuracy": real_news_accuracy,
-                "FakeNewsAccuracy": fake_news_accuracy
-            }
-        }, f, indent=2, ensure_ascii=False)
+            "metrics": metrics
+        }, indent=2, ensure_ascii=False))
 
     # 打印指标
-    print(f"Overall Accuracy: {accuracy:.2%}")
-    print(f"Precision: {precision:.2%}")
-    print(f"Recall: {recall:.2%}")
-    print(f"F1 Score: {f1_score:.2%}")
-    print(f"Real News Accuracy: {real_news_accuracy:.2%}")
-    print(f"Fake News Accuracy: {fake_news_accuracy:.2%}")
+    print(f"Overall Accuracy: {metrics['OverallAccuracy']:.2%}")
+    print(f"Precision: {metrics['Precision']:.2%}")
+    print(f"Recall: {metrics['Recall']:.2%}")
+    print(f"F1 Score: {metrics['F1_Score']:.2%}")
+    print(f"Real News Accuracy: {metrics['RealNewsAccuracy']:.2%}")
+    print(f"Fake News Accuracy: {metrics['FakeNewsAccuracy']:.2%}")
     print(f"Comparison results saved to {output_comparison_file}")
-    print(f"Potential Propagators Count: {potential_propagators_count}")
+    print(f"Potential Propagators Count: {len(potential_propagators)}")
+
+def sweep_fusion(predicted_file, ground_truth_file, sweep_output_file, alphas=SWEEP_ALPHAS, betas=SWEEP_BETAS,
+                 thresholds=SWEEP_THRESHOLDS, metric="OverallAccuracy"):
+    """
+    扫描融合规则 alpha * 基础得分比例 + beta * 情感叙事得分比例 >= threshold 的参数网格。
+
+    FactScore、Fact_withScore、all_num 和正确答案只读取一次，每个 alpha 对全部 beta × threshold
+    做一次广播计算。结果表和按 metric 选出的最佳参数写入 sweep_output_file。
+    """
+    if not os.path.exists(predicted_file) or not os.path.exists(ground_truth_file):
+        print("One or both input files do not exist.")
+        return
+
+    predicted_results = load_records(predicted_file)
+    with open(ground_truth_file, 'r', encoding='utf-8') as f:
+        ground_truth_data = json.load(f)
+
+    ids, fact_scores, fact_with_scores, all_nums = load_score_arrays(predicted_results)
+    truth_ids = [entry["id"] for entry in ground_truth_data]
+    size = max([0, *truth_ids, *ids.tolist()]) + 1
+    ground_truth_by_id = id_lookup(truth_ids, [int(entry["Label"]) for entry in ground_truth_data], size, -1, np.int64)
+
+    # 与 calculate_metrics 相同：跳过 all_num 为零和没有正确答案的记录
+    ground_truth_labels = ground_truth_by_id[ids]
+    compared = (all_nums != 0) & (ground_truth_labels != -1)
+    fact_ratio = fact_scores[compared] / all_nums[compared]
+    fact_with_ratio = fact_with_scores[compared] / all_nums[compared]
+    truths = ground_truth_labels[compared]
+
+    alphas = np.asarray(alphas, dtype=np.float64)
+    betas = np.asarray(betas, dtype=np.float64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    # metrics[name] 的形状为 (alpha, beta, threshold)
+    metrics = {}
+    for i, alpha in enumerate(alphas):
+        fused = alpha * fact_ratio + betas[:, None] * fact_with_ratio  # (beta, n)
+        predictions = (fused[:, None, :] >= thresholds[None, :, None] - SWEEP_EPSILON).astype(np.int64)
+        for name, values in confusion_metrics(predictions, truths).items():
+            if name not in metrics:
+                metrics[name] = np.zeros((len(alphas), len(betas), len(thresholds)), dtype=np.float64)
+            metrics[name][i] = values
+
+    grid = np.stack(np.meshgrid(alphas, betas, thresholds, indexing="ij"), axis=-1).reshape(-1, 3)
+    table = [
+        {"alpha": float(alpha), "beta": float(beta), "threshold": float(threshold),
+         **{name: float(metrics[name].flat[k]) for name in SWEEP_METRIC_NAMES}}
+        for k, (alpha, beta, threshold) in enumerate(grid)
+    ]
+    best = table[int(np.argmax(metrics[metric]))]
+
+    with open(sweep_output_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            "num_claims": int(compared.sum()),
+            "metric": metric,
+            "best": best,
+            "table": table
+        }, f, indent=2, ensure_ascii=False)
+
+    print(f"Evaluated {len(table)} settings on {int(compared.sum())} claims")
+    print(f"Best {metric}: {best[metric]:.2%} at alpha={best['alpha']}, beta={best['beta']}, "
+          f"threshold={best['threshold']}")
+    print(f"Precision: {best['Precision']:.2%}, Recall: {best['Recall']:.2%}, F1 Score: {best['F1_Score']:.2%}, "
+          f"Real News Accuracy: {best['RealNewsAccuracy']:.2%}, Fake News Accuracy: {best['FakeNewsAccuracy']:.2%}")
+    print(f"Fake News Precision: {best['FakePrecision']:.2%}, Fake News Recall: {best['FakeRecall']:.2%}, "
+          f"Fake News F1 Score: {best['FakeF1_Score']:.2%}, Macro F1: {best['MacroF1']:.2%}")
+    print(f"Sweep results saved to {sweep_output_file}")
+    return best
+
 
 # 调用函数
 if __name__ == "__main__":
-    calculate_metrics(predicted_file, ground_truth_file, output_comparison_file)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep", action="store_true", help="扫描 alpha、beta 和阈值网格，而不是计算默认设置的指标")
+    parser.add_argument("--alphas", type=float, nargs="+", default=SWEEP_ALPHAS)
+    parser.add_argument("--betas", type=float, nargs="+", default=SWEEP_BETAS)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=SWEEP_THRESHOLDS)
+    parser.add_argument("--metric", default="OverallAccuracy", choices=SWEEP_METRIC_NAMES, help="选择最佳参数所依据的指标")
+    args = parser.parse_args()
+
+    if args.sweep:
+        sweep_fusion(predicted_file, ground_truth_file, sweep_output_file, args.alphas, args.betas, args.thresholds,
+                     args.metric)
+    else:
+        calculate_metrics(predicted_file, ground_truth_file, output_comparison_file)
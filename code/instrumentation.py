@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import functools
+import contextlib
+from llm_backend import record_call
+
+# 设置后记录每次 LLM 调用和各阶段的 span，退出时在该目录写出 Prometheus 文本格式的指标和 JSON trace
+TRACE_DIR = os.environ.get("TRACE_DIR", "")
+# trace 中最多保留的事件数，超出后只更新指标
+TRACE_MAX_EVENTS = int(os.environ.get("TRACE_MAX_EVENTS", "200000"))
+# 延迟直方图的桶上界（秒）
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# 这些模块中的帧不算调用点，向上找到第一个业务函数
+_BACKEND_MODULES = {"llm_backend.py", "llm_cache.py", "batch_scheduler.py", "instrumentation.py"}
+
+METRIC_HELP = {
+    "llm_calls_total": "LLM calls by method, call site and outcome",
+    "llm_prompts_total": "Prompts sent to the LLM backend",
+    "llm_prompt_tokens_total": "Prompt tokens processed by the model",
+    "llm_generated_tokens_total": "Tokens generated by the model",
+    "llm_call_seconds": "Wall time of LLM calls",
+    "llm_phase_seconds": "Time LLM calls spent waiting for the backend, in prefill and in decode",
+    "spans_total": "Stage spans by name and outcome",
+    "span_seconds": "Wall time of stage spans",
+}
+
+
+def call_site():
+    """调用后端的业务函数名，例如 answer_questions、verify_prompts、classify"""
+    frame = sys._getframe(2)
+    while frame is not None and os.path.basename(frame.f_code.co_filename) in _BACKEND_MODULES:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+
+class Tracer:
+    """
+    收集 span（每条声明在每个阶段的处理过程，以及解析、读写等步骤）和其中的 LLM 调用，
+    同时维护计数器和延迟直方图。线程安全，流水线的多个阶段线程可以共用。
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.dropped = 0
+        self.counters = {}  # (指标名, 标签) -> 值
+        self.histograms = {}  # (指标名, 标签) -> [各桶计数..., 总和, 次数]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for k, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[k] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def _event(self, name, category, start, duration, args):
+        if len(self.events) >= TRACE_MAX_EVENTS:
+            self.dropped += 1
+            return
+        self.events.append({"name": name, "cat": category, "ph": "X", "pid": self.pid,
+                             "tid": threading.get_ident(), "ts": (start - self.start) * 1e6,
+                             "dur": duration * 1e6, "args": args})
+
+    @contextlib.contextmanager
+    def span(self, name, claims=None):
+        """记录一段处理过程；claims 为这段过程涉及的声明 id（单个或列表）"""
+        if claims is not None and not isinstance(claims, (list, tuple)):
+            claims = [claims]
+        stack = self._stack()
+        stack.append(name)
+        start = time.perf_counter()
+        outcome, error = "ok", None
+        try:
+            yield
+        except Exception as e:
+            outcome, error = "error", f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            args = {"claims": claims, "outcome": outcome, "parent": stack[-1] if stack else None}
+            if error is not None:
+                args["error"] = error
+            with self._lock:
+                self._inc("spans_total", {"span": name, "outcome": outcome})
+                self._observe("span_seconds", {"span": name}, duration)
+                self._event(name, "span", start, duration, args)
+
+    def record_call(self, method, site, prompts, start, duration, record, outcome, error=None):
+        """记录一次 LLM 调用；排队、预填充和解码按先后顺序画成调用内部的三段"""
+        stack = self._stack()
+        labels = {"method": method, "site": site}
+        other = max(duration - record["queue"] - record["prefill"] - record["decode"], 0)
+        args = {"site": site, "prompts": prompts, "prompt_tokens": record["prompt_tokens"],
+                "generated_tokens": record["generated_tokens"], "queue": record["queue"],
+                "prefill": record["prefill"], "decode": record["decode"], "other": other,
+                "outcome": outcome, "span": stack[-1] if stack else None}
+        if error is not None:
+            args["error"] = error
+        with self._lock:
+            self._inc("llm_calls_total", {**labels, "outcome": outcome})
+            self._inc("llm_prompts_total", labels, prompts)
+            self._inc("llm_prompt_tokens_total", labels, record["prompt_tokens"])
+            self._inc("llm_generated_tokens_total", labels, record["generated_tokens"])
+            self._observe("llm_call_seconds", labels, duration)
+            self._event(f"llm.{method}", "llm", start, duration, args)
+            offset = start
+            for phase in ("queue", "prefill", "decode"):
+                self._observe("llm_phase_seconds", {"site": site, "phase": phase}, record[phase])
+                if record[phase] > 0:
+                    self._event(phase, "llm_phase", offset, record[phase], {"site": site})
+                    offset += record[phase]
+
+    def prometheus_text(self):
+        """Prometheus 文本格式的计数器和直方图"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        def format_labels(labels, extra=()):
+            items = [f'{key}="{value}"' for key, value in (*labels, *extra)]
+            return "{" + ",".join(items) + "}" if items else ""
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            describe(name, "histogram")
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, trace_dir):
+        """写出 metrics_<pid>.prom 和 trace_<pid>.json（Chrome trace 格式，可在 Perfetto 中查看）"""
+        os.makedirs(trace_dir, exist_ok=True)
+        metrics_file = os.path.join(trace_dir, f"metrics_{self.pid}.prom")
+        trace_file = os.path.join(trace_dir, f"trace_{self.pid}.json")
+        with open(metrics_file, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        with self._lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                     "otherData": {"dropped_events": self.dropped}}
+        with open(trace_file, 'w', encoding='utf-8') as f:
+            json.dump(trace, f, ensure_ascii=False)
+        print(f"Wrote {len(trace['traceEvents'])} trace events to {trace_file} and metrics to {metrics_file}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_tracer():
+    """进程内共享的 Tracer，未设置 TRACE_DIR 时返回 None"""
+    if not TRACE_DIR:
+        return None
+    tracer = Tracer()
+    atexit.register(tracer.export, TRACE_DIR)
+    return tracer
+
+
+def span(name, claims=None):
+    """阶段代码中使用的 span；未启用时不做任何事"""
+    tracer = get_tracer()
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span(name, claims)
+
+
+def traced(name, claims=None):
+    """把函数的整次调用记为一个 span；claims 从函数参数中取出声明 id"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = get_tracer()
+            if tracer is None:
+                return function(*args, **kwargs)
+            with tracer.span(name, claims(*args, **kwargs) if claims else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedBackend:
+    """在最外层包住后端，记录每次调用的调用点、prompt 数、token 数、排队/预填充/解码耗时和结果"""
+
+    def __init__(self, backend, tracer):
+        self.backend = backend
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _traced(self, method, prompts, call):
+        site = call_site()
+        start = time.perf_counter()
+        outcome, error = "ok", None
+        with record_call() as record:
+            try:
+                return call()
+            except Exception as e:
+                outcome, error = "error", f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                self.tracer.record_call(method, site, prompts, start, time.perf_counter() - start, record,
+                                        outcome, error)
+
+    def generate_batch(self, prompts, *args, **kwargs):
+        return self._traced("generate_batch", len(prompts),
+                            lambda: self.backend.generate_batch(prompts, *args, **kwargs))
+
+    def generate_with_prefix(self, prefix, suffixes, *args, **kwargs):
+        return self._traced("generate_with_prefix", len(suffixes),
+                            lambda: self.backend.generate_with_prefix(prefix, suffixes, *args, **kwargs))
+
+    def score_labels(self, prompts, *args, **kwargs):
+        return self._traced("score_labels", len(prompts), lambda: self.backend.score_labels(prompts, *args, **kwargs))
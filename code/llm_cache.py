@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from llm_backend import LABEL_SCORING_REVISION
+
+# 缓存文件路径，未设置时不启用缓存
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH")
+# 缓存最多保留的条目数，超出后按最近访问时间淘汰
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "2000000"))
+# 命中时更新的访问时间先记在内存中，攒够这么多条（或写入、淘汰时）再一起写回
+LLM_CACHE_TOUCH_BATCH = int(os.environ.get("LLM_CACHE_TOUCH_BATCH", "1000"))
+
+
+def cache_key(model_id, method, params, prompt):
+    """按模型、调用方式、生成参数和 prompt 计算内容寻址的键"""
+    payload = json.dumps([model_id, method, params, prompt], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """基于 SQLite 的持久化 LLM 响应缓存，所有阶段共享同一个文件"""
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES, touch_batch=LLM_CACHE_TOUCH_BATCH):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self._touched = {}  # 尚未写回的访问时间：key -> last_access
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get_many(self, keys):
+        """批量查询，返回 key -> value，未命中的键不在结果中"""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            now = time.time()
+            self._touched.update((key, now) for key in found)
+            if len(self._touched) >= self.touch_batch:
+                self._write_touched()
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """批量写入 key -> value"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            # 确定性调用的结果不会变化，已有的键（例如别的进程刚写入的）保持不变，只统计新插入的行
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO responses (key, value, last_access) VALUES (?, ?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False), now) for key, value in items.items()]
+            )
+            self._size += self._conn.total_changes - before
+            self._write_touched()
+            self._conn.commit()
+            if self._size > self.max_entries:
+                self._evict()
+
+    def _write_touched(self):
+        """把攒下的访问时间写回（不提交），调用方持有锁"""
+        if self._touched:
+            self._conn.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                   [(now, key) for key, now in self._touched.items()])
+            self._touched = {}
+
+    def flush(self):
+        """写回尚未写入的访问时间，退出前调用"""
+        with self._lock:
+            self._write_touched()
+            self._conn.commit()
+
+    def _evict(self):
+        """淘汰最久未访问的条目，直到数量降到上限的 90%"""
+        self._write_touched()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        excess = self._size - int(self.max_entries * 0.9)
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)", (excess,)
+        )
+        self._conn.commit()
+        self._size -= excess
+        self.evictions += excess
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0
+        return (f"LLM cache {self.path}: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self._size} entries, {self.evictions} evicted")
+
+
+class CachedBackend:
+    """
+    在任意后端外包一层响应缓存。只缓存确定性的调用（do_sample=False 的生成和标签打分），
+    采样生成直接交给内部后端。
+    """
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _cached_call(self, method, params, prompts, compute):
+        """按 prompt 查缓存，只把未命中的 prompt 交给 compute 批量计算"""
+        keys = [cache_key(self.backend.model_id, method, params[i], prompt) for i, prompt in enumerate(prompts)]
+        found = self.cache.get_many(list(set(keys)))
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            computed = compute(missing)
+            new_items = {keys[i]: value for i, value in zip(missing, computed)}
+            self.cache.put_many(new_items)
+            found.update(new_items)
+        return [found[key] for key in keys]
+
+    def generate_batch(self, prompts, max_new_tokens=16, do_sample=False, temperature=None, max_length=512, stop=None):
+        if do_sample:
+            return self.backend.generate_batch(prompts, max_new_tokens=max_new_tokens, do_sample=do_sample,
+                                               temperature=temperature, max_length=max_length, stop=stop)
+        if isinstance(max_new_tokens, int):
+            max_new_tokens = [max_new_tokens] * len(prompts)
+        params = [{"max_new_tokens": limit, "max_length": max_length, "stop": stop} for limit in max_new_tokens]
+
+        def compute(indices):
+            return self.backend.generate_batch([prompts[i] for i in indices],
+                                               max_new_tokens=[max_new_tokens[i] for i in indices],
+                                               max_length=max_length, stop=stop)
+
+        return self._cached_call("generate", params, prompts, compute)
+
+    def generate_with_prefix(self, prefix, suffixes, max_new_tokens=256, do_sample=False, temperature=None,
+                             max_length=1024, num_return_sequences=1, stop=None):
+        if do_sample:
+            return self.backend.generate_with_prefix(prefix, suffixes, max_new_tokens=max_new_tokens,
+                                                     do_sample=do_sample, temperature=temperature,
+                                                     max_length=max_length, num_return_sequences=num_return_sequences,
+                                                     stop=stop)
+        params = [{"max_new_tokens": max_new_tokens, "max_length": max_length, "stop": stop}] * len(suffixes)
+
+        def compute(indices):
+            return self.backend.generate_with_prefix(prefix, [suffixes[i] for i in indices],
+                                                     max_new_tokens=max_new_tokens, max_length=max_length, stop=stop)
+
+        # 贪心解码时多个返回序列相同，缓存一份后展开
+        outputs = self._cached_call("generate", params, [prefix + suffix for suffix in suffixes], compute)
+        return [output for output in outputs for _ in range(num_return_sequences)]
+
+    def score_labels(self, prompts, candidates, max_length=512):
+        params = [{"candidates": candidates, "max_length": max_length, "revision": LABEL_SCORING_REVISION}] * len(prompts)
+
+        def compute(indices):
+            return self.backend.score_labels([prompts[i] for i in indices], candidates, max_length=max_length)
+
+        return [tuple(value) for value in self._cached_call("score", params, prompts, compute)]
+
+
+if __name__ == "__main__":
+    import sys
+
+    # 查看缓存状态：python llm_cache.py [cache.sqlite]
+    cache = ResponseCache(sys.argv[1] if len(sys.argv) > 1 else LLM_CACHE_PATH)
+    print(cache.report())
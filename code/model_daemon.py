@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import itertools
+import socketserver
+from llm_backend import (TokenizedPrompt, LLM_BACKEND, create_raw_backend, new_stats, record_call, add_to_call,
+                         add_timing)
+
+# 常驻模型进程的 Unix socket 路径；设置后各脚本通过它调用已加载的模型，连不上时回退为在本进程中加载
+LLM_DAEMON_SOCKET = os.environ.get("LLM_DAEMON_SOCKET", "")
+# 未设置 LLM_DAEMON_SOCKET 时守护进程默认监听的路径
+DEFAULT_SOCKET = "/tmp/llm_daemon.sock"
+
+# 客户端可以调用的后端方法
+REMOTE_METHODS = {"generate_batch", "generate_with_prefix", "score_labels", "encode", "count_tokens"}
+
+
+def encode_value(value):
+    """TokenizedPrompt 在 JSON 中会退化成普通字符串，这里连同 token id 一起传输"""
+    if isinstance(value, TokenizedPrompt):
+        return {"text": str(value), "token_ids": list(value.token_ids)}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and set(value) == {"text", "token_ids"}:
+        return TokenizedPrompt(value["text"], value["token_ids"])
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """一个客户端连接：逐行读取 JSON 请求并返回结果，连接内的逐步解码批次保存在 decode_batches 中"""
+
+    def handle(self):
+        self.decode_batches = {}
+        for line in self.rfile:
+            request = json.loads(line)
+            try:
+                response = self.server.dispatch(request, self.decode_batches)
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            if request["method"] == "shutdown":
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class ModelDaemon(socketserver.ThreadingUnixStreamServer):
+    """
+    常驻模型进程：启动时加载一次模型，通过 Unix socket 为多个脚本提供生成、打分和分词。
+    请求逐个执行（模型只有一份），每个响应附带这次请求在后端计数器上的增量和调用记录，
+    客户端据此维护自己的统计，基准测试和埋点的结果与在本进程中加载模型时一致。
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, backend):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # 上次异常退出留下的 socket 文件
+        super().__init__(socket_path, DaemonHandler)
+        os.chmod(socket_path, 0o600)  # 只允许当前用户连接
+        self.socket_path = socket_path
+        self.backend = backend
+        self.started = time.time()
+        self.requests = 0
+        self.batch_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def dispatch(self, request, decode_batches):
+        method = request["method"]
+        if method in ("hello", "shutdown"):
+            return {"result": {"model_id": self.backend.model_id, "backend": LLM_BACKEND, "pid": os.getpid(),
+                               "batch_size": self.backend.batch_size, "uptime": time.time() - self.started,
+                               "requests": self.requests, "stats": self.backend.stats}}
+
+        args = decode_value(request.get("args", []))
+        kwargs = request.get("kwargs", {})
+        wait_start = time.perf_counter()
+        with self._lock:
+            wait = time.perf_counter() - wait_start
+            self.requests += 1
+            before = dict(self.backend.stats)
+            with record_call() as record:
+                if method in REMOTE_METHODS:
+                    result = getattr(self.backend, method)(*args, **kwargs)
+                elif method == "decode_batch":
+                    result = next(self.batch_ids)
+                    decode_batches[result] = self.backend.decode_batch(*args, **kwargs)
+                elif method == "decode_add":
+                    batch = decode_batches[request["batch"]]
+                    batch.add(request["key"], args[0])
+                    result = len(batch)
+                elif method == "decode_step":
+                    batch = decode_batches[request["batch"]]
+                    result = {"finished": batch.step(), "size": len(batch)}
+                elif method == "decode_close":
+                    result = decode_batches.pop(request["batch"], None) is not None
+                else:
+                    raise ValueError(f"Unknown method: {method}")
+            stats = {name: self.backend.stats[name] - before[name] for name in before}
+        # 等待其他客户端的请求计为排队时间
+        stats["queue_seconds"] += wait
+        record["queue"] += wait
+        return {"result": encode_value(result), "stats": stats, "record": record}
+
+
+class DaemonDecodeBatch:
+    """守护进程中的逐步解码批次，接口与 GLMDecodeBatch 相同；序列的 key 留在客户端"""
+
+    def __init__(self, client, batch_id):
+        self.client = client
+        self.batch_id = batch_id
+        self.keys = {}  # 句柄 -> key
+        self.handles = itertools.count()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key, suffix):
+        handle = next(self.handles)
+        self.keys[handle] = key
+        self.size = self.client.request("decode_add", [suffix], batch=self.batch_id, key=handle)
+
+    def step(self):
+        response = self.client.request("decode_step", batch=self.batch_id)
+        self.size = response["size"]
+        return [(self.keys.pop(handle), text) for handle, text in response["finished"]]
+
+    def __del__(self):
+        try:
+            self.client.request("decode_close", batch=self.batch_id)
+        except Exception:
+            pass
+
+
+class DaemonBackend:
+    """
+    常驻模型进程的客户端，接口与 GLMBackend 相同。第一次调用时才连接；
+    守护进程不存在、加载的模型与本进程的配置不同或中途断开时，回退为在本进程中加载的 local 后端。
+    """
+
+    def __init__(self, socket_path, local):
+        self.socket_path = socket_path
+        self.local = local
+        self.model_id = local.model_id
+        self.batch_size = local.batch_size
+        self.stats = new_stats()
+        self._file = None
+        self._fallback = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.local, name)
+
+    def _fall_back(self, reason):
+        print(f"Model daemon at {self.socket_path} {reason}; loading the model in this process")
+        self._fallback = True
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _connect(self):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+        except OSError as e:
+            self._fall_back(f"is not available ({e})")
+            return
+        self._file = sock.makefile("rwb")
+        info = self._exchange({"method": "hello"})["result"]
+        if info["model_id"] != self.model_id or info["backend"] != LLM_BACKEND:
+            self._fall_back(f"serves {info['backend']}/{info['model_id']}, not {LLM_BACKEND}/{self.model_id}")
+
+    def _exchange(self, request):
+        self._file.write((json.dumps(request) + "\n").encode("utf-8"))
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        return json.loads(line)
+
+    def request(self, method, args=(), kwargs=None, **fields):
+        """发送一个请求，把响应中的计数器增量和调用记录计入本进程；守护进程不可用时返回 None"""
+        wait_start = time.perf_counter()
+        with self._lock:
+            add_timing(self.stats, "queue", time.perf_counter() - wait_start)
+            if self._file is None and not self._fallback:
+                self._connect()
+            if self._fallback:
+                return None
+            response = self._exchange({"method": method, "args": encode_value(list(args)), "kwargs": kwargs or {},
+                                       **fields})
+        if "error" in response:
+            raise RuntimeError(f"Model daemon error in {method}: {response['error']}")
+        for name, value in response["stats"].items():
+            self.stats[name] += value
+        add_to_call(**response["record"])
+        return decode_value(response["result"])
+
+    def _call(self, method, *args, **kwargs):
+        if not self._fallback:
+            try:
+                result = self.request(method, args, kwargs)
+            except (OSError, ConnectionError) as e:
+                self._fall_back(f"disconnected ({e})")
+            else:
+                if not self._fallback:
+                    return result
+        before = dict(self.local.stats)
+        result = getattr(self.local, method)(*args, **kwargs)
+        for name in self.stats:
+            self.stats[name] += self.local.stats[name] - before[name]
+        return result
+
+    def encode(self, text):
+        return self._call("encode", text)
+
+    def count_tokens(self, text):
+        return self._call("count_tokens", text)
+
+    def generate_batch(self, prompts, *args, **kwargs):
+        return self._call("generate_batch", prompts, *args, **kwargs)
+
+    def generate_with_prefix(self, prefix, suffixes, *args, **kwargs):
+        return self._call("generate_with_prefix", prefix, suffixes, *args, **kwargs)
+
+    def score_labels(self, prompts, *args, **kwargs):
+        # JSON 中的元组变成了列表
+        return [tuple(item) for item in self._call("score_labels", prompts, *args, **kwargs)]
+
+    def decode_batch(self, prefix, **kwargs):
+        if not self._fallback:
+            try:
+                batch_id = self.request("decode_batch", [prefix], kwargs)
+            except (OSError, ConnectionError) as e:
+                self._fall_back(f"disconnected ({e})")
+            else:
+                if batch_id is not None:
+                    return DaemonDecodeBatch(self, batch_id)
+        return self.local.decode_batch(prefix, **kwargs)
+
+
+def daemon_request(socket_path, method):
+    """向守护进程发送一个管理请求（hello / shutdown），守护进程不存在时返回 None"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            with sock.makefile("rwb") as f:
+                f.write((json.dumps({"method": method}) + "\n").encode("utf-8"))
+                f.flush()
+                return json.loads(f.readline())["result"]
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    # 例：LLM_DAEMON_SOCKET=/tmp/llm_daemon.sock python model_daemon.py &
+    #     LLM_DAEMON_SOCKET=/tmp/llm_daemon.sock python pipeline.py
+    parser = argparse.ArgumentParser(description="常驻模型进程：加载一次模型，通过 Unix socket 为各阶段脚本提供服务")
+    parser.add_argument("--socket", default=LLM_DAEMON_SOCKET or DEFAULT_SOCKET)
+    parser.add_argument("--status", action="store_true", help="查看正在运行的守护进程")
+    parser.add_argument("--stop", action="store_true", help="停止正在运行的守护进程")
+    args = parser.parse_args()
+
+    if args.status or args.stop:
+        info = daemon_request(args.socket, "shutdown" if args.stop else "hello")
+        if info is None:
+            print(f"No model daemon at {args.socket}")
+            raise SystemExit(1)
+        print(f"{info['backend']}/{info['model_id']} (pid {info['pid']}), up {info['uptime']:.0f}s, "
+              f"{info['requests']} requests, {info['stats']['calls']} calls")
+        if args.stop:
+            print(f"Stopped model daemon at {args.socket}")
+        raise SystemExit(0)
+
+    backend = create_raw_backend()
+    start = time.time()
+    if hasattr(backend, "_load"):
+        backend._load()  # 启动时就加载模型，之后的客户端不再等待
+    server = ModelDaemon(args.socket, backend)
+    print(f"Loaded {LLM_BACKEND}/{backend.model_id} in {time.time() - start:.1f}s; serving on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,272 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import argparse
+import threading
+import unicodedata
+import numpy as np
+from record_io import load_records
+from sharded_runner import STAGES, STAGE_OUTPUTS
+
+# 近重复索引文件（SQLite），未设置时不启用；索引随处理过的声明持续增长
+NEAR_DUP_INDEX = os.environ.get("NEAR_DUP_INDEX", "")
+# 归一化文本的字符 shingle Jaccard 相似度达到该值才视为近重复
+NEAR_DUP_THRESHOLD = float(os.environ.get("NEAR_DUP_THRESHOLD", "0.8"))
+
+# MinHash 签名长度与 LSH 分带：32 带 × 每带 4 个值，相似度 0.8 的声明几乎总会成为候选
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(20240521)  # 固定种子，签名在不同进程、不同次运行之间可比
+_A = _rng.randint(1, _PRIME, NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, NUM_PERM).astype(np.uint64)
+
+# 转发时常见的改动：链接、#话题#、@用户、开头的【】标题、[表情] 以及标点、空白和 emoji
+_URL = re.compile(r"https?://\S+")
+_HASHTAG = re.compile(r"#[^#]{1,40}#")
+_MENTION = re.compile(r"@[\w\-]{1,30}")
+_HEADER = re.compile(r"^(\s*【[^】]{0,30}】)+")
+_EMOTICON = re.compile(r"\[[^\[\]\s]{1,8}\]")
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_claim(text):
+    """去掉转发时的修饰（话题、标题、表情、链接、@、标点和 emoji），全角转半角并统一小写"""
+    text = unicodedata.normalize("NFKC", text)
+    text = _URL.sub("", text)
+    text = _HASHTAG.sub("", text)
+    text = _MENTION.sub("", text)
+    text = _HEADER.sub("", text)
+    text = _EMOTICON.sub("", text)
+    return _NON_WORD.sub("", text).lower()
+
+
+def shingles(normalized):
+    """归一化文本的字符 n-gram 集合"""
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized} if normalized else set()
+    return {normalized[k:k + SHINGLE_SIZE] for k in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def minhash(shingle_set):
+    """MinHash 签名：对每个 shingle 的哈希做 NUM_PERM 个 (a·x + b) mod p 置换后取最小值"""
+    hashes = np.array([zlib.crc32(s.encode("utf-8")) % _PRIME for s in shingle_set], dtype=np.uint64)
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0)
+
+
+def band_keys(signature):
+    """每个带的签名哈希成一个桶号"""
+    return [int.from_bytes(hashlib.blake2b(signature[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest(),
+                           "big", signed=True)
+            for band in range(BANDS)]
+
+
+class NearDuplicateIndex:
+    """
+    持久化、增量的近重复声明索引（SQLite）。每条已处理的声明保存归一化文本、MinHash 的 LSH 桶
+    以及各阶段的结果记录；新声明先按桶找候选，再用精确的 shingle Jaccard 相似度确认。
+    复用关系写入 links 表，便于审计。线程安全。
+    刚进入流水线、还没有结果的声明可以先登记（register，只保存在内存中），
+    在它完成之前到达的近重复声明通过 find_pending 找到它并等待它的结果。
+    """
+
+    def __init__(self, path=NEAR_DUP_INDEX, threshold=NEAR_DUP_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._pending = {}  # 已登记、尚未完成的声明：id -> (shingle 集合, 桶号)
+        self._pending_buckets = {}  # (带, 桶号) -> id 集合
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS claims ("
+            "id INTEGER PRIMARY KEY, claim TEXT NOT NULL, normalized TEXT NOT NULL, records TEXT NOT NULL, "
+            "added REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, id INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS buckets_key ON buckets(band, bucket)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS links ("
+            "id INTEGER PRIMARY KEY, source_id INTEGER NOT NULL, similarity REAL NOT NULL, claim TEXT NOT NULL, "
+            "linked REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM claims").fetchone()[0]
+
+    def add(self, claim_id, claim, records):
+        """把一条已完成各阶段的声明及其结果记录加入索引（同一 id 再次加入时覆盖）"""
+        normalized = normalize_claim(claim)
+        shingle_set = shingles(normalized)
+        if not shingle_set:
+            return
+        keys = band_keys(minhash(shingle_set))
+        with self._lock:
+            self._conn.execute("DELETE FROM buckets WHERE id = ?", (claim_id,))
+            self._conn.execute("INSERT OR REPLACE INTO claims (id, claim, normalized, records, added) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               (claim_id, claim, normalized, json.dumps(records, ensure_ascii=False), time.time()))
+            self._conn.executemany("INSERT INTO buckets (band, bucket, id) VALUES (?, ?, ?)",
+                                   [(band, key, claim_id) for band, key in enumerate(keys)])
+            self._conn.commit()
+            self._unregister(claim_id)
+
+    def register(self, claim_id, claim):
+        """登记一条刚进入流水线、尚未完成的声明；add 加入索引时自动注销"""
+        shingle_set = shingles(normalize_claim(claim))
+        if not shingle_set:
+            return
+        keys = band_keys(minhash(shingle_set))
+        with self._lock:
+            self._pending[claim_id] = (shingle_set, keys)
+            for band, key in enumerate(keys):
+                self._pending_buckets.setdefault((band, key), set()).add(claim_id)
+
+    def unregister(self, claim_id):
+        """注销一条登记过、但在某个阶段失败而不会完成的声明，之后到达的近重复声明不再跟随它"""
+        with self._lock:
+            self._unregister(claim_id)
+
+    def _unregister(self, claim_id):
+        entry = self._pending.pop(claim_id, None)
+        if entry is None:
+            return
+        for band, key in enumerate(entry[1]):
+            bucket = self._pending_buckets[(band, key)]
+            bucket.discard(claim_id)
+            if not bucket:
+                del self._pending_buckets[(band, key)]
+
+    def find_pending(self, claim, exclude_id=None):
+        """
+        在已登记、尚未完成的声明中查找与 claim 最相似的一条。
+
+        返回：
+            dict | None: {"id", "similarity"}，没有达到阈值的候选时为 None
+        """
+        shingle_set = shingles(normalize_claim(claim))
+        if not shingle_set:
+            return None
+        keys = band_keys(minhash(shingle_set))
+        with self._lock:
+            candidates = set()
+            for band, key in enumerate(keys):
+                candidates.update(self._pending_buckets.get((band, key), ()))
+            candidates.discard(exclude_id)
+            best = None
+            for candidate in candidates:
+                similarity = jaccard(shingle_set, self._pending[candidate][0])
+                if similarity >= self.threshold and (best is None or similarity > best["similarity"]):
+                    best = {"id": candidate, "similarity": similarity}
+        return best
+
+    def find(self, claim, exclude_id=None):
+        """
+        查找与 claim 最相似的已处理声明。
+
+        返回：
+            dict | None: {"id", "claim", "similarity", "records"}，没有达到阈值的候选时为 None
+        """
+        shingle_set = shingles(normalize_claim(claim))
+        if not shingle_set:
+            return None
+        keys = band_keys(minhash(shingle_set))
+        with self._lock:
+            candidates = set()
+            for band, key in enumerate(keys):
+                rows = self._conn.execute("SELECT id FROM buckets WHERE band = ? AND bucket = ?", (band, key))
+                candidates.update(row[0] for row in rows)
+            candidates.discard(exclude_id)
+            best = None
+            for candidate in candidates:
+                row = self._conn.execute("SELECT claim, normalized FROM claims WHERE id = ?",
+                                         (candidate,)).fetchone()
+                if row is None:
+                    continue
+                similarity = jaccard(shingle_set, shingles(row[1]))
+                if similarity >= self.threshold and (best is None or similarity > best["similarity"]):
+                    best = {"id": candidate, "claim": row[0], "similarity": similarity}
+            if best is not None:
+                best["records"] = json.loads(self._conn.execute("SELECT records FROM claims WHERE id = ?",
+                                                                (best["id"],)).fetchone()[0])
+        return best
+
+    def link(self, claim_id, source_id, similarity, claim):
+        """记录 claim_id 复用了 source_id 的结果"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO links (id, source_id, similarity, claim, linked) "
+                               "VALUES (?, ?, ?, ?, ?)", (claim_id, source_id, similarity, claim, time.time()))
+            self._conn.commit()
+
+    def links(self):
+        with self._lock:
+            return self._conn.execute("SELECT id, source_id, similarity FROM links ORDER BY id").fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def reused_records(match, claim_id, claim):
+    """把匹配声明的各阶段记录改写为 claim_id 的记录，附上来源 id 和相似度"""
+    records = {}
+    for stage, record in match["records"].items():
+        record = {**record, "id": claim_id, "duplicate_of": match["id"], "similarity": round(match["similarity"], 4)}
+        if "claim" in record:
+            record["claim"] = claim
+        records[stage] = record
+    return records
+
+
+def index_outputs(output_dir, index):
+    """把 output_dir 中各阶段都已完成的声明加入索引（由其他声明复用得到的结果不加入）"""
+    outputs = {stage: {record["id"]: record for record in load_records(os.path.join(output_dir, STAGE_OUTPUTS[stage]))}
+               for stage in STAGES}
+    added = 0
+    for claim_id, record in outputs[STAGES[-1]].items():
+        records = {stage: outputs[stage].get(claim_id) for stage in STAGES}
+        if any(r is None for r in records.values()) or "duplicate_of" in record:
+            continue
+        index.add(claim_id, records[STAGES[0]]["claim"], records)
+        added += 1
+    return added
+
+
+if __name__ == "__main__":
+    # 例：python near_duplicate.py /root/LX/Generation/near_duplicates.sqlite --build /root/LX/Generation
+    #     python near_duplicate.py /root/LX/Generation/near_duplicates.sqlite --query "#扩散# 【紧急】..."
+    parser = argparse.ArgumentParser(description="近重复声明索引：从流水线输出建立索引、查询和查看复用记录")
+    parser.add_argument("index", nargs="?", default=NEAR_DUP_INDEX)
+    parser.add_argument("--build", metavar="OUTPUT_DIR", help="把该目录中已完成的声明加入索引")
+    parser.add_argument("--query", help="查找与该声明近重复的已处理声明")
+    parser.add_argument("--links", action="store_true", help="列出复用记录")
+    parser.add_argument("--threshold", type=float, default=NEAR_DUP_THRESHOLD)
+    args = parser.parse_args()
+    if not args.index:
+        parser.error("index path is required (or set NEAR_DUP_INDEX)")
+
+    index = NearDuplicateIndex(args.index, args.threshold)
+    if args.build:
+        print(f"Indexed {index_outputs(args.build, index)} claims from {args.build}")
+    if args.query:
+        match = index.find(args.query)
+        if match is None:
+            print("No near-duplicate found")
+        else:
+            print(f"ID {match['id']} (similarity {match['similarity']:.3f}): {match['claim']}")
+    if args.links:
+        for claim_id, source_id, similarity in index.links():
+            print(f"ID {claim_id} reused results of ID {source_id} (similarity {similarity:.3f})")
+    print(f"{len(index)} claims in {args.index}")
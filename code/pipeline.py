@@ -0,0 +1,340 @@
+import os
+import time
+import queue
+import argparse
+import threading
+from llm_backend import BATCH_SIZE
+from record_io import RecordWriter, RecordIndex
+from claim_store import iter_claims
+from program_ir import parse_program
+from sharded_runner import STAGES, STAGE_OUTPUTS, load_generator
+from Analyze_emo_and_nt import analyze_batch, analysis_fingerprint
+from program_execution import execute_record, execution_fingerprint, analysis_inputs, LAZY_EVAL
+from fact_scoring import score_record, score_fingerprint
+from near_duplicate import NearDuplicateIndex, reused_records, NEAR_DUP_INDEX
+
+# 文件路径
+input_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json")
+output_dir = os.path.join(os.path.dirname(__file__), "/root/LX/Generation")  # 各阶段的审计输出目录
+
+# 阶段之间队列的容量（条），决定了流水线中同时存在的声明数上限
+QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", str(4 * BATCH_SIZE)))
+# 凑批时最多等待的时间（秒），上游慢时不会一直等到批次填满
+BATCH_WAIT = float(os.environ.get("PIPELINE_BATCH_WAIT", "0.05"))
+
+_DONE = object()  # 结束标记，由上游传给下游
+
+
+def take_batch(inbox, batch_size, max_wait):
+    """
+    阻塞取到第一条后，在 max_wait 秒内尽量凑满一个批次。
+
+    返回：
+        (list, bool): 本批次的条目，以及是否已收到结束标记
+    """
+    item = inbox.get()
+    if item is _DONE:
+        return [], True
+    batch = [item]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < batch_size:
+        timeout = deadline - time.monotonic()
+        try:
+            item = inbox.get(timeout=max(timeout, 0)) if timeout > 0 else inbox.get_nowait()
+        except queue.Empty:
+            break
+        if item is _DONE:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+def generate_stage(items):
+    return load_generator().generate_program_batch([(item["id"], item["claim"]) for item in items])
+
+
+def analyze_stage(items):
+    return analyze_batch([item["generate"] for item in items])
+
+
+def execute_stage(items):
+    results = []
+    for item in items:
+        analysis = analysis_inputs(item["analyze"])
+        irs = [parse_program(program) for program in item["generate"]["predicted_programs"]]
+        result = execute_record(item["generate"], irs, analysis, lazy=LAZY_EVAL)
+        result["fingerprint"] = execution_fingerprint(item["generate"], analysis, LAZY_EVAL)
+        results.append(result)
+    return results
+
+
+def score_stage(items):
+    return [score_record(item["execute"]) for item in items]
+
+
+STAGE_FUNCTIONS = {
+    "generate": generate_stage,
+    "analyze": analyze_stage,
+    "execute": execute_stage,
+    "score": score_stage,
+}
+
+# 各阶段记录的输入指纹，与单独运行各脚本时相同
+STAGE_FINGERPRINTS = {
+    "generate": lambda item: load_generator().program_fingerprint(item["claim"]),
+    "analyze": lambda item: analysis_fingerprint(item["claim"]),
+    "execute": lambda item: execution_fingerprint(item["generate"], analysis_inputs(item["analyze"]), LAZY_EVAL),
+    "score": lambda item: score_fingerprint(item["execute"]),
+}
+
+
+class StageWorker(threading.Thread):
+    """
+    一个阶段的工作线程：从 inbox 按批取声明，调用阶段函数，把结果写入审计文件后交给 outbox。
+    审计文件中输入指纹没有变化的记录直接复用，不再调用模型；带有近重复来源记录的声明
+    直接写入来源声明的结果。来源声明仍在流水线中（source）时，它在每个阶段都先于近重复声明处理，
+    近重复声明取它在本阶段的结果；来源声明在本阶段失败时近重复声明改为自己计算。
+    本阶段失败、不再流向下游的声明交给 on_drop。
+    """
+
+    def __init__(self, name, inbox, outbox, output_file, batch_size=BATCH_SIZE, on_record=None, on_drop=None):
+        super().__init__(name=name, daemon=True)
+        self.stage = name
+        self.inbox = inbox
+        self.outbox = outbox
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self.on_record = on_record
+        self.on_drop = on_drop
+        self.processed = 0
+        self.reused = 0
+        self.deduplicated = 0
+        self.busy = 0.0  # 在阶段函数中花费的时间
+        self.index = RecordIndex(output_file)
+
+    def run(self):
+        try:
+            with RecordWriter(self.output_file) as writer:
+                done = False
+                while not done:
+                    batch, done = take_batch(self.inbox, self.batch_size, BATCH_WAIT)
+                    if batch:
+                        self.process(batch, writer)
+        finally:
+            self.outbox.put(_DONE)
+
+    def _write_duplicate(self, item, record, writer, records):
+        """
+        写入近重复声明复用的记录。记录保留来源声明的指纹而不是按自己的输入计算的指纹，
+        不使用近重复索引重新运行时会重新计算；复用同一来源结果的记录已经写过时直接读取。
+        """
+        if self.index.is_current(item["id"], record.get("fingerprint")):
+            records[item["id"]] = self.index.read(item["id"])
+            self.reused += 1
+            return
+        self.index.add(record, writer.write(record))
+        records[item["id"]] = record
+        self.deduplicated += 1
+
+    def _compute(self, items, writer, records):
+        """调用阶段函数计算 items，结果写入审计文件并放入 records；失败时这批声明没有结果"""
+        if not items:
+            return
+        start = time.time()
+        try:
+            new_records = STAGE_FUNCTIONS[self.stage](items)
+        except Exception as e:
+            print(f"Error in {self.stage} for claim IDs {items[0]['id']}-{items[-1]['id']}: {e}")
+            new_records = []  # 忽略当前批次，继续处理下一批
+        self.busy += time.time() - start
+        for record in new_records:
+            self.index.add(record, writer.write(record))
+            records[record["id"]] = record
+            self.processed += 1
+
+    def process(self, batch, writer):
+        records, pending = {}, []  # pending 为需要重新计算的条目
+        waiting = []  # 来源声明与它在同一批次中计算的近重复声明
+        pending_ids = set()
+        for item in batch:
+            # 来源声明在本批次或之前批次中本阶段的结果
+            source = item.get("source")
+            source_result = records.get(source["item"]["id"], source["item"].get(self.stage)) if source else None
+            if self.index.is_current(item["id"], STAGE_FINGERPRINTS[self.stage](item)):
+                records[item["id"]] = self.index.read(item["id"])
+                self.reused += 1
+                # 已有自己的结果时后续阶段也不再混用近重复声明的结果
+                item.pop("duplicate", None)
+                item.pop("source", None)
+            elif "duplicate" in item:
+                self._write_duplicate(item, item["duplicate"][self.stage], writer, records)
+            elif source_result is not None:
+                self._write_duplicate(item, source_record(item, self.stage, source_result), writer, records)
+            elif source is not None and source["item"]["id"] in pending_ids:
+                waiting.append(item)
+            else:
+                item.pop("source", None)  # 来源声明没有本阶段的结果，自己计算
+                pending.append(item)
+                pending_ids.add(item["id"])
+        self._compute(pending, writer, records)
+        fallback = []  # 来源声明在本阶段失败，改为自己计算
+        for item in waiting:
+            source_id = item["source"]["item"]["id"]
+            if source_id in records:
+                self._write_duplicate(item, source_record(item, self.stage, records[source_id]), writer, records)
+            else:
+                item.pop("source")
+                fallback.append(item)
+        self._compute(fallback, writer, records)
+        pending += fallback
+
+        computed = ({item["id"] for item in batch if "duplicate" in item or "source" in item}
+                    | {item["id"] for item in pending})
+        for item in batch:
+            record = records.get(item["id"])
+            if record is None:
+                if self.on_drop is not None:
+                    self.on_drop(item)
+                continue
+            item[self.stage] = record
+            if self.on_record is not None and item["id"] in computed:
+                self.on_record(item)
+            self.outbox.put(item)
+
+
+def duplicate_records(index, item):
+    """
+    在近重复索引中查找 item 的来源声明。来源声明的各阶段记录在当前配置下仍然有效（指纹与现在计算的相同）时，
+    返回改写为 item 的记录，否则返回 None。
+    """
+    match = index.find(item["claim"], exclude_id=item["id"])
+    if match is None or set(match["records"]) != set(STAGES):
+        return None
+    source = {"id": match["id"], "claim": match["claim"]}
+    for stage in STAGES:
+        if STAGE_FINGERPRINTS[stage](source) != match["records"][stage].get("fingerprint"):
+            return None
+        source[stage] = match["records"][stage]
+    return reused_records(match, item["id"], item["claim"])
+
+
+def source_record(item, stage, record):
+    """把仍在流水线中的来源声明在 stage 的结果改写为近重复声明 item 的记录"""
+    source = item["source"]
+    match = {"id": source["item"]["id"], "similarity": source["similarity"], "records": {stage: record}}
+    return reused_records(match, item["id"], item["claim"])[stage]
+
+
+def run_pipeline(input_file, output_dir, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, near_dup_index=NEAR_DUP_INDEX):
+    """
+    生成 → 情感叙事分析 → 执行 → 打分 的流式流水线：每个阶段一个线程，阶段之间用有界队列连接，
+    声明逐批流过各阶段，内存占用取决于队列容量而不是数据集大小。
+
+    各阶段的结果仍写入 output_dir 下与单独运行时同名的 JSONL 文件，便于审计，也可以交给 getlabel.py；
+    这些文件不再是阶段之间的交接点。重新运行时每个阶段只重新计算输入指纹变化的记录，
+    其余记录从审计文件中读取。
+
+    设置 near_dup_index 时，与之前处理过的声明近重复（转发时只改了话题、标题、表情等）的声明直接复用
+    来源声明的程序、情感叙事分析、执行和打分结果，记录中带有 duplicate_of 和 similarity，复用关系同时写入索引；
+    完整处理过的声明在流出流水线时加入索引。声明进入流水线时先登记在索引中，
+    来源声明还在处理时到达的近重复声明跟在它后面，逐阶段取用它的结果。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {stage: os.path.join(output_dir, STAGE_OUTPUTS[stage]) for stage in STAGES}
+    dup_index = NearDuplicateIndex(near_dup_index) if near_dup_index else None
+    in_flight = {}  # 已登记、尚未流出流水线的声明：id -> 条目
+
+    start = time.time()
+    first_verdict = []
+
+    def report_verdict(item):
+        if not first_verdict:
+            first_verdict.append(time.time() - start)
+        score = item["score"]
+        source = f", reused ID {score['duplicate_of']}" if "duplicate_of" in score else ""
+        print(f"Verdict for ID {item['id']}: FactScore {score['FactScore']}/{score['all_num']}, "
+              f"Fact_withScore {score['Fact_withScore']}/{score['all_num']} ({time.time() - start:.1f}s{source})")
+
+    # 在某个阶段失败的声明不会流出流水线：注销登记，之后到达的近重复声明改为自己计算
+    def drop_claim(item):
+        if dup_index is not None:
+            dup_index.unregister(item["id"])
+        in_flight.pop(item["id"], None)
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(STAGES) + 1)]
+    workers = [
+        StageWorker(stage, queues[k], queues[k + 1], paths[stage], batch_size,
+                    on_record=report_verdict if stage == "score" else None, on_drop=drop_claim)
+        for k, stage in enumerate(STAGES)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # 最后一个队列需要清空，否则满了会阻塞最终阶段；同时维护近重复索引
+    def drain_results():
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            if dup_index is None:
+                continue
+            score = item["score"]
+            if "duplicate_of" in score:
+                dup_index.link(item["id"], score["duplicate_of"], score["similarity"], item["claim"])
+            else:
+                dup_index.add(item["id"], item["claim"], {stage: item[stage] for stage in STAGES})
+            in_flight.pop(item["id"], None)
+
+    drain = threading.Thread(target=drain_results, daemon=True)
+    drain.start()
+
+    # 主线程读取声明放入第一个队列，队列满时等待下游
+    submitted = 0
+    try:
+        for item in iter_claims(input_file):
+            if not item.get("Claim"):
+                print(f"Skipping item {item['id']}: Missing claim.")
+                continue
+            entry = {"id": item["id"], "claim": item["Claim"]}
+            if dup_index is not None:
+                # 先找仍在处理中的来源声明：它一旦完成就会从登记中移到索引里，两处不会同时错过
+                match = dup_index.find_pending(entry["claim"], exclude_id=entry["id"])
+                source = in_flight.get(match["id"]) if match is not None else None
+                duplicate = duplicate_records(dup_index, entry) if source is None else None
+                if source is not None:
+                    entry["source"] = {"item": source, "similarity": match["similarity"]}
+                elif duplicate is not None:
+                    entry["duplicate"] = duplicate
+                else:
+                    in_flight[entry["id"]] = entry
+                    dup_index.register(entry["id"], entry["claim"])
+            queues[0].put(entry)
+            submitted += 1
+    finally:
+        queues[0].put(_DONE)
+    for worker in workers:
+        worker.join()
+    drain.join()
+
+    elapsed = time.time() - start
+    print(f"Submitted {submitted} claims, finished in {elapsed:.1f}s")
+    if first_verdict:
+        print(f"First verdict after {first_verdict[0]:.1f}s")
+    for worker in workers:
+        print(f"{worker.stage}: {worker.processed} computed, {worker.reused} reused, "
+              f"{worker.deduplicated} from near-duplicates, {worker.busy:.1f}s busy "
+              f"({worker.busy / elapsed if elapsed > 0 else 0:.0%} of wall time)")
+    if dup_index is not None:
+        print(f"Near-duplicate index {near_dup_index}: {len(dup_index)} claims, {len(dup_index.links())} reuse links")
+        dup_index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="流式运行完整流水线")
+    parser.add_argument("--input", default=input_file)
+    parser.add_argument("--output-dir", default=output_dir)
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    parser.add_argument("--near-dup-index", default=NEAR_DUP_INDEX, help="近重复声明索引文件（SQLite）")
+    args = parser.parse_args()
+
+    run_pipeline(args.input, args.output_dir, args.queue_size, near_dup_index=args.near_dup_index)
@@ -1,42 +1,21 @@
 import os
 import json
 import re
-from transformers import AutoTokenizer, AutoModel
-
-# 设置模型和分词器路径
-MODEL_PATH = os.environ.get('MODEL_PATH', '/root/autodl-tmp/glm-4-9b-chat')
-TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", MODEL_PATH)
-
-# 加载分词器和模型
-tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, trust_remote_code=True)
-model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, device_map="auto").eval()
+import numpy as np
+from llm_backend import get_backend, LABEL_SCORING, LABEL_SCORING_ID
+from program_ir import load_compiled_programs, format_step, schedule_levels, IR_VERSION
+from record_io import RecordWriter, RecordIndex, load_records, fingerprint, record_hash
+from claim_store import render_prompt
+from instrumentation import span, traced
+from getlabel import fuse_labels
 
 # 文件路径
-execute_program_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/execute_program.json")
-emotion_narrative_analysis_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/emotion_narrative_analysis.json")
-result_file = os.path.join(os.path.dirname(__file__), "result.json")
+execute_program_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/execute_program.jsonl")
+emotion_narrative_analysis_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/emotion_narrative_analysis.jsonl")
+result_file = os.path.join(os.path.dirname(__file__), "result.jsonl")
 
-
-def get_last_processed_id(output_file):
-    try:
-        with open(output_file, 'r', encoding='utf-8') as file:
-            max_id = 0
-            id_pattern = re.compile(r'"id"\s*:\s*(\d+)')
-
-            for line in file:
-                matches = id_pattern.findall(line)
-                for match in matches:
-                    num = int(match)
-                    if max_id is None or num > max_id:
-                        max_id = num
-            print(max_id)
-            return max_id
-    except FileNotFoundError:
-        print(f"文件 {output_file} 未找到。")
-    except Exception as e:
-        print(f"发生错误: {e}")
-
-    return 0
+# 短路求值：标签确定后不再发出剩余的 Verify 调用
+LAZY_EVAL = os.environ.get("LAZY_EVAL", "0") == "1"
 
 
 def load_emotion_narrative_analysis(file_path):
@@ -44,174 +23,300 @@ def load_emotion_narrative_analysis(file_path):
     if not os.path.exists(file_path):
        raise FileNotFoundError(f"{file_path} does not exist.")
    
-    with open(file_path, 'r', encoding='utf-8') as f:
-       try:
-           analysis_data = json.load(f)  # 读取整个 JSON 数组
-       except json.JSONDecodeError as e:
-           print(f"JSONDecodeError: {e}")
-           return {}
-    return {item["id"]: {"emotion": item.get("emotion", "neutral"), "narrative_techniques": item.get("narrative_techniques", [])} for item in analysis_data}
-
-
-def extract_commands(program):
-    """从 def program() 中提取所有命令"""
-    commands = []
-    lines = program.split("\n")
-    for line in lines:
-        line = line.strip()
-        if line and ("= Question" in line or "= Verify" in line or "= Predict" in line):
-            commands.append(line)
-    return commands
+    try:
+        analysis_data = load_records(file_path)  # 读取 JSONL 或 JSON 数组
+    except json.JSONDecodeError as e:
+        print(f"JSONDecodeError: {e}")
+        return {}
+    return {item["id"]: analysis_inputs(item) for item in analysis_data}
 
-def answer_question(question,claim):
+
+def analysis_inputs(item):
+    """执行阶段用到的分析结果字段"""
+    return {"emotion": item.get("emotion", "neutral"), "narrative_techniques": item.get("narrative_techniques", [])}
+
+
+# Question 回答的句子结束符
+SENTENCE_TERMINATORS = [".", "。"]
+
+# Prompt 模板；声明文本（{claim} / {message}）在启用声明存储时直接拼接缓存的 token id
+QUESTION_PROMPT_TEMPLATE = "I read the following information: {claim}.Answer the following question with few words as briefly as possible, not necessarily in a complete sentence:\n{question}\nThe answer is:"
+VERIFY_PROMPT_TEMPLATE = "I read the following message {message}.Is the following statement true or false?\n\"{claim}\"Answer only with True or False:"
+VERIFY_WITH_INFORMATION_PROMPT_TEMPLATE = "I read the following information {message}.{information}\nBased on the above, is the following statement true or false?\n\"{claim}\"\nAnswer only with True or False:"
+
+def build_question_prompt(question, claim):
+   return render_prompt(QUESTION_PROMPT_TEMPLATE, {"{claim}": claim, "{question}": question})
+
+def answer_questions(questions, claim):
    """
-   调用 LLM 生成回答，并返回第一个句子，去掉原始的 prompt。
+   批量调用 LLM 回答同一条声明下的多个问题，每个问题只返回第一个句子。
    根据问题长度动态调整 max_new_tokens。
    """
-   prompt = f"I read the following information: {claim}.Answer the following question with few words as briefly as possible, not necessarily in a complete sentence:\n{question}\nThe answer is:"
-   inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=1024).to(model.device)
+   prompts = [build_question_prompt(question, claim) for question in questions]
    
    # 动态调整 max_new_tokens，假设每个单词平均需要 1.5 个 token
-   question_length = len(question.split())
-   max_new_tokens = int(question_length * 1.5) + 10  # 加 10 以确保有足够的空间生成完整句子
-   outputs = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
-   response = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-    # 去掉原始的 prompt 部分
-   if response.startswith(prompt):
-       response = response[len(prompt):].strip()
+   max_new_tokens = [int(len(question.split()) * 1.5) + 10 for question in questions]  # 加 10 以确保有足够的空间生成完整句子
+   # 生成出第一个句子结束符后立即停止
+   responses = get_backend().generate_batch(prompts, max_new_tokens=max_new_tokens, max_length=1024,
+                                            stop=SENTENCE_TERMINATORS)
     # 只返回第一个句子
-   first_sentence = response.split('.')[0] + '.'
-   return first_sentence
+   return [re.split('[.。]', response.strip())[0] + '.' for response in responses]
 
+def answer_question(question,claim):
+   """
+   调用 LLM 生成回答，并返回第一个句子，去掉原始的 prompt。
+   """
+   return answer_questions([question], claim)[0]
 
-def verify_command(claim, message):
-   prompt = f"I read the following message {message}.Is the following statement true or false?\n\"{claim}\"Answer only with True or False:"
-   inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512).to(model.device)
-   
-   # 动态调整 max_new_tokens，假设每个单词平均需要 1.5 个 token
-   prompt_length = len(prompt.split())
-   max_new_tokens = int(prompt_length * 0.1) + 4  # 加 4 以确保有足够的空间生成完整句子
-   
-   outputs = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
-   result = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-   #print("result:", result)
-   if result.startswith(prompt):
-       result = result[len(prompt):].strip()
-   #print("result:", result)
-   if result.find("True") != -1:
-      return "True"
-   elif result.find("False") != -1:
-      return "False"
-   return None  # 如果都不包含，返回 None 或其他适当的值
 
-def verify_with_information_from_file(claim, emotion, narrative_techniques, message):
+# Verify 的候选标签
+VERIFY_LABELS = ["True", "False"]
+
+def build_verify_prompt(claim, message):
+   return render_prompt(VERIFY_PROMPT_TEMPLATE, {"{message}": message, "{claim}": claim})
+
+def build_verify_with_information_prompt(claim, emotion, narrative_techniques, message):
    information = f"The information contains {emotion} emotions and employs {narrative_techniques} narrative techniques."
-   prompt = f"I read the following information {message}.{information}\nBased on the above, is the following statement true or false?\n\"{claim}\"\nAnswer only with True or False:"
-   inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512).to(model.device)
-   
-   # 动态调整 max_new_tokens
-   prompt_length = len(prompt.split())
-   max_new_tokens = int(prompt_length * 0.1) + 5  # 加 5 以确保有足够的空间生成完整句子
-   
-   outputs = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
-   result = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-   #print("result:", result)
-   if result.startswith(prompt):
-       result = result[len(prompt):].strip()
-   #print("result:", result)
+   return render_prompt(VERIFY_WITH_INFORMATION_PROMPT_TEMPLATE,
+                        {"{message}": message, "{information}": information, "{claim}": claim})
+
+def parse_verify_result(result):
    if result.find("True") != -1:
       return "True"
    elif result.find("False") != -1:
       return "False"
    return None  # 如果都不包含，返回 None 或其他适当的值
 
+def verify_prompts(prompts, extra_tokens=4):
+   """
+   批量执行 Verify，返回 (标签, 置信度) 列表。extra_tokens 可以按 prompt 分别指定。
+   logit 模式下单次前向比较 True/False 的概率；generate 模式下生成文本后匹配，置信度为 None。
+   """
+   if LABEL_SCORING == "logit":
+      return get_backend().score_labels(prompts, VERIFY_LABELS, max_length=512)
+
+   # 动态调整 max_new_tokens，假设每个单词平均需要 1.5 个 token
+   if isinstance(extra_tokens, int):
+      extra_tokens = [extra_tokens] * len(prompts)
+   max_new_tokens = [int(len(prompt.split()) * 0.1) + extra for prompt, extra in zip(prompts, extra_tokens)]  # 加 extra_tokens 以确保有足够的空间生成完整句子
+   results = get_backend().generate_batch(prompts, max_new_tokens=max_new_tokens, max_length=512)
+   return [(parse_verify_result(result.strip()), None) for result in results]
 
+def verify_command(claim, message):
+   return verify_prompts([build_verify_prompt(claim, message)], extra_tokens=4)[0][0]
 
-def execute_programs(execute_program_file, emotion_narrative_analysis_file, result_file):
+def verify_with_information_from_file(claim, emotion, narrative_techniques, message):
+   prompt = build_verify_with_information_prompt(claim, emotion, narrative_techniques, message)
+   return verify_prompts([prompt], extra_tokens=5)[0][0]
+
+
+
+def execution_fingerprint(program_data, analysis, lazy=False):
+    """
+    执行结果的输入指纹：上游程序记录的内容、程序 IR 的版本、用到的分析结果、Question/Verify 的 prompt 模板、模型和打分方式。
+    模板用占位符渲染后参与计算，修改任何一个 prompt 都会使指纹变化。
+    """
+    templates = [
+        build_question_prompt("{question}", "{claim}"),
+        build_verify_prompt("{claim}", "{message}"),
+        build_verify_with_information_prompt("{claim}", "{emotion}", "{narrative_techniques}", "{message}"),
+    ]
+    return fingerprint(record_hash(program_data), IR_VERSION, analysis, templates, SENTENCE_TERMINATORS, get_backend().model_id,
+                       LABEL_SCORING_ID, lazy)
+
+
+def _new_state(ir):
+    """一个程序在执行过程中的中间结果"""
+    return {
+        "ir": ir,
+        "levels": schedule_levels(ir) if ir["valid"] else [],
+        "fact_results": {},  # 基本验证结果
+        "fact_with_results": {},  # 带情绪和叙述技巧的验证结果
+        "fact_confidences": {},  # 基本验证的置信度
+        "fact_with_confidences": {},  # 第二轮验证的置信度
+        "questions": {},  # 存储问题变量
+        "answers": {},  # 用于存储 Question 的答案
+        "decided": False,  # lazy 模式下标签已经确定
+    }
+
+
+def execute_steps(irs, qclaim, analysis, lazy=False):
+    """
+    同时执行同一条声明的一个或多个程序 IR 中的 Question 与两轮 Verify，返回每个程序的中间结果。
+    不依赖答案的步骤同批发出，调用批次数等于依赖图的深度而不是步骤数；
+    替换答案之后文本相同的 Question 和 Verify 在所有程序中只调用一次，结果共享。
+
+    lazy 为 True 时按短路求值执行：getlabel 只有在两轮的所有 fact 都为 True 时才判为真，
+    因此先完成第一轮，某个程序出现非 True 结果后它的标签已经确定，不再为它发出后续依赖层和第二轮的调用。
+    短路的粒度是依赖层和轮次：同一层的 Verify 仍作为一个批次一起发出，不会在层内第一个非 True 处停下，
+    没有 Question 的程序只能省掉第二轮。该等价性依赖于 alpha + beta = 1 且阈值为 1 的融合规则。
+    """
+    states = [_new_state(ir) for ir in irs]
+    emotion = analysis.get("emotion", "neutral")
+    narrative_techniques = analysis.get("narrative_techniques", [])
+    depth = max((len(state["levels"]) for state in states), default=0)
+
+    # 非 lazy 模式下同一层的两轮 Verify 一起打分；lazy 模式下第一轮全部为 True 才执行第二轮
+    passes = [("basic",), ("with",)] if lazy else [("basic", "with")]
+    for rounds in passes:
+        # 按依赖层执行：同一层的 Question 一起生成，同一层的 Verify 一起打分，只在真正有依赖的地方等待
+        for k in range(depth):
+            active = [state for state in states if not state["decided"] and k < len(state["levels"])]
+
+            question_targets = {}  # 问题文本 -> [(程序, 变量)]
+            for state in active:
+                for step in state["levels"][k]:
+                    if step["op"] == "Question" and step["var"] not in state["answers"]:
+                        text = format_step(step, state["answers"])  # 替换嵌套变量
+                        question_targets.setdefault(text, []).append((state, step["var"]))
+            if question_targets:
+                texts = list(question_targets)
+                for text, answer in zip(texts, answer_questions(texts, qclaim)):
+                    for state, var in question_targets[text]:
+                        state["answers"][var] = answer
+                        state["questions"][var] = text
+
+            verify_targets = {}  # prompt -> (extra_tokens, [(程序, 标签表, 置信度表, 键)])
+            for round_name in rounds:
+                for state in active:
+                    for step in state["levels"][k]:
+                        if step["op"] != "Verify":
+                            continue
+                        text = format_step(step, state["answers"])
+                        if round_name == "basic":
+                            # 第一轮：基本 Verify
+                            prompt, extra = build_verify_prompt(text, qclaim), 4
+                            target = (state, state["fact_results"], state["fact_confidences"], step["var"])
+                        else:
+                            # 第二轮：带情绪和叙述技巧的 Verify
+                            prompt, extra = build_verify_with_information_prompt(text, emotion, narrative_techniques, qclaim), 5
+                            target = (state, state["fact_with_results"], state["fact_with_confidences"], step["var"]+"with")
+                        verify_targets.setdefault(prompt, (extra, []))[1].append(target)
+            if verify_targets:
+                prompts = list(verify_targets)
+                outcomes = verify_prompts(prompts, extra_tokens=[verify_targets[prompt][0] for prompt in prompts])
+                for prompt, (label, confidence) in zip(prompts, outcomes):
+                    for state, labels, confidences, key in verify_targets[prompt][1]:
+                        labels[key], confidences[key] = label, confidence
+                        if lazy and label != "True":
+                            state["decided"] = True  # 已出现非 True 的 fact，该程序的标签确定为 false
+    return states
+
+
+def _program_result(program_id, qclaim, state, lazy):
+    """由一个程序的中间结果生成结果记录，按程序中的步骤顺序输出"""
+    ir = state["ir"]
+    steps = ir["steps"] if ir["valid"] else []
+    verify_vars = [step["var"] for step in steps if step["op"] == "Verify"]
+    questions, answers = state["questions"], state["answers"]
+    fact_results, fact_with_results = state["fact_results"], state["fact_with_results"]
+    fact_confidences, fact_with_confidences = state["fact_confidences"], state["fact_with_confidences"]
+    result = {
+        "id": program_id,
+        "claim": qclaim,
+        "Question": {var: questions[var] for var in (step["var"] for step in steps) if var in questions},
+        "answers": {var: answers[var] for var in (step["var"] for step in steps) if var in answers},
+        "basic_verification": {var: fact_results[var] for var in verify_vars if var in fact_results},  # 第一轮验证结果
+        "emotion_narrative_verification": {var+"with": fact_with_results[var+"with"] for var in verify_vars if var+"with" in fact_with_results},  # 第二轮验证结果
+        "basic_confidence": {var: fact_confidences[var] for var in verify_vars if var in fact_confidences},
+        "emotion_narrative_confidence": {var+"with": fact_with_confidences[var+"with"] for var in verify_vars if var+"with" in fact_with_confidences},
+        "num_facts": len(verify_vars)
+    }
+    if lazy:
+        skipped = [step["var"] for step in steps if step["op"] == "Question" and step["var"] not in answers]
+        skipped += [var for var in verify_vars if var not in fact_results]
+        skipped += [var+"with" for var in verify_vars if var+"with" not in fact_with_results]
+        result["skipped_steps"] = skipped
+    if ir["error"]:
+        result["program_error"] = ir["error"]  # 不合法的程序没有执行任何步骤，部分不合法的程序只执行了能解析的步骤
+    return result
+
+
+@traced("execute", lambda program_id, *args, **kwargs: program_id)
+def execute_program_ir(program_id, qclaim, ir, analysis, lazy=False):
+    """
+    按程序 IR 执行一条声明的 Question 与两轮 Verify，返回结果记录（执行方式见 execute_steps）。
+    lazy 模式下跳过的步骤记录在 skipped_steps 中。
+    """
+    return _program_result(program_id, qclaim, execute_steps([ir], qclaim, analysis, lazy)[0], lazy)
+
+
+def program_label(result):
+    """按 getlabel 的融合规则由一个程序的执行结果得到标签"""
+    fact_score = sum(1 for label in result["basic_verification"].values() if label == "True")
+    fact_with_score = sum(1 for label in result["emotion_narrative_verification"].values() if label == "True")
+    return int(fuse_labels(np.array([fact_score], dtype=np.float64), np.array([fact_with_score], dtype=np.float64),
+                           np.array([result["num_facts"]], dtype=np.float64))[0])
+
+
+@traced("execute", lambda program_id, *args, **kwargs: program_id)
+def execute_program_samples(program_id, qclaim, irs, weights, analysis, lazy=False):
+    """
+    自洽性投票：一起执行同一条声明的多个采样程序，相同的步骤只调用一次。
+    每个程序按融合规则得到标签，以采样次数 weights 为票数多数投票；无法解析的程序不参与投票，
+    平票时取票数最多的程序的标签。返回记录的顶层字段来自与投票结果一致、票数最多的程序，
+    因此打分和 getlabel 得到的就是投票结果；votes 为各标签的票数，samples 为每个程序的验证结果。
+    """
+    states = execute_steps(irs, qclaim, analysis, lazy)
+    results = [_program_result(program_id, qclaim, state, lazy) for state in states]
+    labels = [program_label(result) for result in results]
+    voters = [k for k, ir in enumerate(irs) if ir["valid"]] or list(range(len(irs)))
+    votes = {}
+    for k in voters:
+        votes[labels[k]] = votes.get(labels[k], 0) + weights[k]
+    winners = [label for label, count in votes.items() if count == max(votes.values())]
+    representative = next(k for k in voters if labels[k] in winners)  # 程序按票数从多到少排列
+
+    result = dict(results[representative])
+    result["votes"] = {str(label): count for label, count in sorted(votes.items())}
+    result["representative"] = representative
+    result["samples"] = [{"weight": weight, "label": label, "basic_verification": sample["basic_verification"],
+                          "emotion_narrative_verification": sample["emotion_narrative_verification"]}
+                         for weight, label, sample in zip(weights, labels, results)]
+    return result
+
+
+def execute_record(program_data, irs, analysis, lazy=False):
+    """执行一条程序记录：只有一个程序时与 execute_program_ir 相同，有多个采样程序时投票"""
+    if len(irs) == 1:
+        return execute_program_ir(program_data["id"], program_data.get("claim", ""), irs[0], analysis, lazy=lazy)
+    weights = program_data.get("program_weights", [1] * len(irs))
+    return execute_program_samples(program_data["id"], program_data.get("claim", ""), irs, weights, analysis, lazy=lazy)
+
+
+def execute_programs(execute_program_file, emotion_narrative_analysis_file, result_file, lazy=LAZY_EVAL):
     # 加载情感和叙述分析文件
     emotion_narrative_map = load_emotion_narrative_analysis(emotion_narrative_analysis_file)
 
-    # 获取最后处理的 ID
-    last_processed_id = get_last_processed_id(result_file)
-    print(f"Last processed ID: {last_processed_id}")
+    # 读取 execute_program 文件，并加载（或生成）预编译的程序 IR
+    programs = load_records(execute_program_file)
+    with span("compile"):
+        compiled_programs = load_compiled_programs(execute_program_file, programs)
 
-    # 读取 execute_program.json 文件
-    with open(execute_program_file, 'r', encoding='utf-8') as f:
-        programs = json.load(f)
+    skipped_steps = 0  # lazy 模式下跳过的步骤数
+
+    # 打开 result_file 以追加模式写入 JSONL，只执行没有结果或输入指纹已变化的程序
+    with RecordWriter(result_file) as writer:
+        index = RecordIndex(result_file)
+        print(f"Existing records: {len(index)}")
 
-    # 打开 result_file 以追加模式写入
-    with open(result_file, 'a', encoding='utf-8') as output_file:
-        if last_processed_id == 0:
-            output_file.write("[\n")  # 添加数组起始符号
-        
         for program_data in programs:
-            # 跳过已处理的 ID
-            if program_data["id"] <= last_processed_id:
+            analysis = emotion_narrative_map.get(program_data["id"], {})
+            result_fingerprint = execution_fingerprint(program_data, analysis, lazy)
+            # 跳过输入没有变化的程序
+            if index.is_current(program_data["id"], result_fingerprint):
                 continue
 
             try:
-                # 提取命令并处理
-                program = program_data["predicted_programs"][0]
-                commands = extract_commands(program)
-                fact_results = {}  # 基本验证结果
-                fact_with_results = {}  # 带情绪和叙述技巧的验证结果
-                questions = {}  # 存储问题变量
-                answers = {}  # 用于存储 Question 的答案
-                qclaim = program_data.get("claim", "")
-                # 第一轮验证：提取问题和执行基本 Verify
-                for command in commands:
-                    if "= Question" in command:
-                        return_var, question = command.split("=")[0].strip(), command.split("Question")[1].strip().strip('(").')
-                        answer = answer_question(question,qclaim)
-                        #print(answer)
-                        answers[return_var] = answer  # 存储答案
-                        questions[return_var] = question
-
-                    elif "= Verify" in command:
-                        fact_idx = command.split("=")[0].strip()
-                        claim = command.split("Verify")[1].strip().strip('(").')
-
-                        # 替换嵌套变量
-                        for key, value in answers.items():
-                            #print("claimbe",claim)
-                            claim = claim.replace(f"{{{key}}}", value)
-                            #print("claimaf",claim)
-
-                        # 调用 Verify 执行基本认证
-                        fact_results[fact_idx] = verify_command(claim,qclaim)
-                        #print(fact_results)
-
-                # 第二轮验证：带情绪和叙述技巧的 Verify
-                for command in commands:
-                    if "= Verify" in command:
-                        fact_idx = command.split("=")[0].strip()
-                        claim = command.split("Verify")[1].strip().strip('(").')
-
-                        # 替换嵌套变量
-                        for key, value in answers.items():
-                            claim = claim.replace(f"{{{key}}}", value)
-
-                        # 读取情绪和叙述技巧数据
-                        analysis = emotion_narrative_map.get(program_data["id"], {})
-                        emotion = analysis.get("emotion", "neutral")
-                        narrative_techniques = analysis.get("narrative_techniques", [])
-
-                        # 调用 Verify 执行带情绪和叙述技巧的认证
-                        fact_with_results[fact_idx+"with"] = verify_with_information_from_file(claim, emotion, narrative_techniques,qclaim)
-                        #print(fact_with_results)
-
-                # 构造结果并写入文件
-                result = {
-                    "id": program_data["id"],
-                    "claim": program_data["claim"],
-                    "Question": questions,
-                    "answers": answers,
-                    "basic_verification": fact_results,  # 第一轮验证结果
-                    "emotion_narrative_verification": fact_with_results  # 第二轮验证结果
-                }
-
-                json.dump(result, output_file, indent=2, ensure_ascii=False)
-                output_file.write(",\n")  # 每条记录以逗号分隔
+                irs = compiled_programs[program_data["id"]]
+                if not any(ir["valid"] for ir in irs):
+                    # 程序不合法时不调用 LLM，只写入带 program_error 的空结果
+                    print(f"Malformed program for ID {program_data['id']}, recording error without model calls: {irs[0]['error']}")
+                result = execute_record(program_data, irs, analysis, lazy=lazy)
+                result["fingerprint"] = result_fingerprint
+                skipped_steps += len(result.get("skipped_steps", []))
+
+                writer.write(result)
 
                 print(f"Processed ID: {program_data['id']}")
 
@@ -219,9 +324,8 @@ def execute_programs(execute_program_file, emotion_narrative_analysis_file, resu
                 print(f"Error processing ID {program_data['id']}: {e}")
                 continue  # 遇到错误时跳过当前声明
 
-        output_file.seek(output_file.tell() - 2, os.SEEK_SET)  # 移动文件指针到最后一个逗号的位置
-        output_file.truncate()
-        output_file.write("]")  # JSON 数组结束符号
+    if lazy:
+        print(f"Skipped steps: {skipped_steps}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,264 @@
+import os
+import re
+import ast
+import json
+import hashlib
+from instrumentation import traced
+
+# IR 格式版本，格式变化时旧的缓存自动失效
+IR_VERSION = 4
+
+# 程序中可调用的函数（模型有时会写成小写）
+STEP_OPS = {"question": "Question", "verify": "Verify"}
+PREDICT_OP = "predict"
+
+
+def _normalize_source(program):
+    """把模型生成的程序整理成可被 ast 解析的 def program(): 函数"""
+    end = program.find("#end")
+    if end != -1:
+        program = program[:end]
+
+    body = []
+    for line in program.split("\n"):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#") or stripped.startswith("def program"):
+            continue
+        # 程序体是平铺的赋值语句，统一缩进可以修复模型输出中不一致的缩进
+        body.append("    " + stripped)
+    return "def program():\n" + ("\n".join(body) if body else "    pass")
+
+
+def _string_template(node):
+    """
+    把 Question/Verify 的参数还原成模板字符串和依赖的变量。
+    f-string 中的 {answer_1} 保留为占位符，依赖记为 answer_1。
+    """
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value, []
+    if isinstance(node, ast.JoinedStr):
+        parts, deps = [], []
+        for value in node.values:
+            if isinstance(value, ast.Constant):
+                parts.append(str(value.value))
+            elif isinstance(value, ast.FormattedValue):
+                expr = ast.unparse(value.value)
+                parts.append("{" + expr + "}")
+                deps.extend(n.id for n in ast.walk(value.value) if isinstance(n, ast.Name))
+        return "".join(parts), deps
+    if isinstance(node, ast.Name):
+        return "{" + node.id + "}", [node.id]
+    raise ValueError(f"Unsupported argument: {ast.unparse(node)}")
+
+
+PLACEHOLDER_PATTERN = re.compile(r'\{(\w+)\}')
+
+
+def _plain_string_deps(text, ir):
+    """
+    模型常把引用答案的 Verify 写成普通字符串（漏掉 f 前缀）。与原来逐条替换 {answer_k} 的做法一致，
+    普通字符串中的 {name} 只要 name 是前面 Question 的结果，就作为占位符和依赖。
+    """
+    questions = {step["var"] for step in ir["steps"] if step["op"] == "Question"}
+    return [name for name in PLACEHOLDER_PATTERN.findall(text) if name in questions]
+
+
+# ast 无法解析的行（如字符串中含有未转义的引号）按 var = Op("...") 的形式兜底
+LINE_PATTERN = re.compile(r'^(\w+)\s*=\s*(\w+)\((f?)(["\'])(.*)\4\)\s*$')
+
+
+def _parse_line_fallback(line, ir):
+    match = LINE_PATTERN.match(line)
+    if not match or match.group(2).lower() not in STEP_OPS:
+        return False
+    var, op, is_fstring, _, text = match.groups()
+    deps = PLACEHOLDER_PATTERN.findall(text) if is_fstring else _plain_string_deps(text, ir)
+    ir["steps"].append({"var": var, "op": STEP_OPS[op.lower()], "text": text, "deps": sorted(set(deps))})
+    return True
+
+
+def _parse_statement(stmt, ir):
+    """解析一条赋值语句，追加到 ir 中"""
+    if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+            and isinstance(stmt.value, ast.Call) and isinstance(stmt.value.func, ast.Name)):
+        return
+    var = stmt.targets[0].id
+    op = stmt.value.func.id.lower()
+    args = stmt.value.args
+
+    if op in STEP_OPS:
+        if len(args) != 1:
+            raise ValueError(f"{var}: {STEP_OPS[op]}() expects one argument")
+        text, deps = _string_template(args[0])
+        if isinstance(args[0], ast.Constant):
+            deps = _plain_string_deps(text, ir)
+        ir["steps"].append({"var": var, "op": STEP_OPS[op], "text": text, "deps": sorted(set(deps))})
+    elif op == PREDICT_OP and args:
+        expr = args[0]
+        ir["predict"] = {
+            "expr": ast.unparse(expr),
+            "facts": sorted({n.id for n in ast.walk(expr) if isinstance(n, ast.Name)}),
+        }
+
+
+@traced("parse")
+def parse_program(program):
+    """
+    用 ast 解析生成的 def program(): 程序，得到紧凑的中间表示（IR）。
+    个别行无法解析或依赖未定义的变量时只去掉这些步骤，其余步骤照常执行，问题记录在 error 中；
+    valid 表示程序中至少还有一个可执行的 Verify 步骤。
+
+    返回：
+        dict: {"valid", "error", "steps": [{"var", "op", "text", "deps"}], "predict": {"expr", "facts"}}
+    """
+    ir = {"valid": False, "error": None, "steps": [], "predict": None}
+    source = _normalize_source(program)
+    try:
+        statements = ast.parse(source).body[0].body
+    except SyntaxError:
+        statements = None
+
+    if statements is not None:
+        for stmt in statements:
+            try:
+                _parse_statement(stmt, ir)
+            except ValueError as e:
+                ir["error"] = str(e)
+    else:
+        # 整体解析失败时逐行解析，尽量保留能解析的步骤
+        for line in source.split("\n")[1:]:
+            line = line.strip()
+            try:
+                for stmt in ast.parse(line).body:
+                    _parse_statement(stmt, ir)
+            except SyntaxError:
+                if not _parse_line_fallback(line, ir):
+                    ir["error"] = f"Syntax error in line: {line}"
+            except ValueError as e:
+                ir["error"] = str(e)
+
+    # 检查依赖：f-string 引用的变量必须是前面 Question/Verify 的结果，否则去掉该步骤
+    defined = set()
+    steps = []
+    for step in ir["steps"]:
+        missing = [dep for dep in step["deps"] if dep not in defined]
+        if missing:
+            ir["error"] = f"{step['var']} depends on undefined {', '.join(missing)}"
+            continue
+        defined.add(step["var"])
+        steps.append(step)
+    ir["steps"] = steps
+
+    ir["valid"] = any(step["op"] == "Verify" for step in ir["steps"])
+    if not ir["valid"]:
+        ir["error"] = ir["error"] or "No Verify step"
+    return ir
+
+
+def canonical_program(program):
+    """
+    程序的规范形式，用于对同一声明的多个采样程序去重：按步骤顺序把变量统一重命名，
+    去掉步骤文本中多余的空白，忽略 Predict 表达式（执行时只用到 Question/Verify 步骤）。
+    无法完整解析的程序退回为整理缩进和注释后的源码。
+    """
+    ir = parse_program(program)
+    if ir["error"]:
+        return _normalize_source(program)
+    names = {}
+    lines = []
+    for step in ir["steps"]:
+        text = " ".join(step["text"].split())
+        for dep in step["deps"]:
+            text = text.replace(f"{{{dep}}}", f"{{{names.get(dep, dep)}}}")
+        names[step["var"]] = f"v{len(names)}"
+        lines.append(f"{names[step['var']]} = {step['op']}({text!r})")
+    return "\n".join(lines)
+
+
+def format_step(step, answers):
+    """把步骤模板中的 {answer_k} 替换为已得到的答案"""
+    text = step["text"]
+    for dep in step["deps"]:
+        text = text.replace(f"{{{dep}}}", answers.get(dep, ""))
+    return text
+
+
+def schedule_levels(ir):
+    """
+    按数据依赖把步骤分层：第 0 层不依赖任何答案，第 k 层只依赖前面各层的结果。
+    同一层内的步骤互不依赖，可以作为一个批次一起交给后端。
+    """
+    depth = {}
+    levels = []
+    for step in ir["steps"]:
+        level = 1 + max((depth[dep] for dep in step["deps"] if dep in depth), default=-1)
+        depth[step["var"]] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(step)
+    return levels
+
+
+def program_hash(program):
+    return hashlib.sha1(program.encode("utf-8")).hexdigest()
+
+
+def ir_file_for(execute_program_file):
+    """IR 缓存文件与 execute_program.jsonl 放在同一目录"""
+    root, _ = os.path.splitext(execute_program_file)
+    return root + "_ir.json"
+
+
+def load_compiled_programs(execute_program_file, programs):
+    """
+    读取预编译的 IR 缓存，只解析缓存中没有或程序文本已变化的记录，必要时写回缓存。
+
+    参数：
+        execute_program_file (str): execute_program.jsonl 路径，IR 缓存保存在其旁边。
+        programs (list[dict]): execute_program.jsonl 中的记录。
+
+    返回：
+        dict: id -> 记录中每个程序的 IR 列表（与 predicted_programs 顺序相同）
+    """
+    ir_file = ir_file_for(execute_program_file)
+    cache = {}
+    if os.path.exists(ir_file):
+        try:
+            with open(ir_file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored.get("version") == IR_VERSION:
+                cache = stored.get("programs", {})
+        except json.JSONDecodeError as e:
+            print(f"JSONDecodeError in {ir_file}: {e}")
+
+    compiled = {}
+    changed = False
+    for program_data in programs:
+        key = str(program_data["id"])
+        programs_text = program_data["predicted_programs"]
+        digest = program_hash(json.dumps(programs_text, ensure_ascii=False))
+        entry = cache.get(key)
+        if entry is None or entry["hash"] != digest:
+            entry = {"hash": digest, "irs": [parse_program(program) for program in programs_text]}
+            cache[key] = entry
+            changed = True
+        compiled[program_data["id"]] = entry["irs"]
+
+    if changed:
+        tmp_file = ir_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"version": IR_VERSION, "programs": cache}, f, ensure_ascii=False)
+        os.replace(tmp_file, ir_file)
+    return compiled
+
+
+if __name__ == "__main__":
+    import sys
+
+    from record_io import load_records
+
+    # 预编译：python program_ir.py execute_program.jsonl
+    data = load_records(sys.argv[1])
+    compiled = load_compiled_programs(sys.argv[1], data)
+    invalid = sum(1 for irs in compiled.values() if not irs[0]["valid"])
+    print(f"Compiled {len(compiled)} programs ({invalid} malformed) into {ir_file_for(sys.argv[1])}")
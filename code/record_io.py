@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import hashlib
+from instrumentation import traced
+
+# 每写入多少条记录做一次 fsync 并更新检查点
+CHECKPOINT_EVERY = int(os.environ.get("CHECKPOINT_EVERY", "50"))
+
+
+def checkpoint_file_for(path):
+    """检查点与输出文件放在一起：result.jsonl -> result.jsonl.ckpt"""
+    return path + ".ckpt"
+
+
+def index_file_for(path):
+    """id 索引与检查点放在一起：result.jsonl -> result.jsonl.idx，每行 [id, 指纹, 字节偏移]"""
+    return path + ".idx"
+
+
+def read_checkpoint(path):
+    """读取检查点，不存在时返回空状态"""
+    try:
+        with open(checkpoint_file_for(path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"offset": 0, "count": 0, "last_id": 0}
+
+
+class RecordWriter:
+    """
+    追加写 JSONL 记录，并定期 fsync、写入检查点。
+
+    启动时只读取检查点和检查点之后的少量尾部数据来恢复 last_id，不需要扫描整个文件；
+    崩溃时写了一半的最后一行会被截掉，文件始终可以逐行解析；旧的 JSON 数组格式输出先原地转换为 JSONL。
+    每条记录的 id、指纹和偏移随检查点追加到 .idx 索引文件，RecordIndex 启动时据此恢复，同样只扫描尾部。
+    """
+
+    def __init__(self, path, checkpoint_every=CHECKPOINT_EVERY):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self._pending_index = []  # 尚未写入 .idx 的 [id, 指纹, 偏移]
+        if os.path.exists(path) and is_json_array(path):
+            self._convert_json_array()
+        state = read_checkpoint(path)
+        if "index_offset" not in state:
+            # 没有索引文件的旧输出：从头扫描一次，下一个检查点写出完整的索引
+            state = {"offset": 0, "count": 0, "last_id": 0, "index_offset": 0}
+        self.count = state["count"]
+        self.last_id = state["last_id"]
+        self.index_offset = state["index_offset"]
+        self._recover(state["offset"])
+        self._truncate_index()
+        self.file = open(path, 'ab')
+        self._since_checkpoint = 0
+
+    def _convert_json_array(self):
+        """把旧的 JSON 数组格式输出原地转换为 JSONL，旧的检查点和索引随之作废"""
+        with open(self.path, 'r', encoding='utf-8') as f:
+            records = json.load(f)  # 数组本身不完整时直接报错，不改动文件
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+        for stale_file in (checkpoint_file_for(self.path), index_file_for(self.path)):
+            if os.path.exists(stale_file):
+                os.remove(stale_file)
+        print(f"Converted JSON array {self.path} to JSONL ({len(records)} records)")
+
+    def _recover(self, offset):
+        """读取检查点之后的尾部：统计完整的行，只截掉没有换行结尾的最后一行"""
+        if not os.path.exists(self.path):
+            self.index_offset = 0
+            return
+        with open(self.path, 'r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            if offset > size:
+                # 检查点比文件新（文件被替换过），只能从头恢复
+                offset, self.count, self.last_id, self.index_offset = 0, 0, 0, 0
+            f.seek(offset)
+            good_end = offset
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 崩溃留下的半行
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        raise ValueError(f"{self.path}: malformed record at byte {good_end}") from e
+                    self._track(record, good_end)
+                good_end += len(line)
+            if good_end < size:
+                f.truncate(good_end)
+
+    def _truncate_index(self):
+        """去掉 .idx 中上一个检查点之后写入的部分（对应的记录已在尾部重新统计）"""
+        index_file = index_file_for(self.path)
+        if os.path.exists(index_file) and os.path.getsize(index_file) > self.index_offset:
+            with open(index_file, 'r+b') as f:
+                f.truncate(self.index_offset)
+
+    def _track(self, record, offset):
+        self.count += 1
+        if isinstance(record.get("id"), int):
+            self.last_id = max(self.last_id, record["id"])
+        self._pending_index.append([record.get("id"), record.get("fingerprint"), offset])
+
+    @traced("write", lambda self, record: record.get("id"))
+    def write(self, record):
+        """追加一条记录，返回它在文件中的字节偏移"""
+        offset = self.file.tell()
+        self.file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.file.flush()  # 让 follow_records 等下游读者立即看到完整的行
+        self._track(record, offset)
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+        return offset
+
+    def _flush_index(self):
+        """把检查点之前的记录追加到 .idx 并 fsync，返回索引文件的新长度"""
+        with open(index_file_for(self.path), 'ab') as f:
+            f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n"
+                            for entry in self._pending_index).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+            self._pending_index = []
+            return f.tell()
+
+    @traced("checkpoint")
+    def checkpoint(self):
+        """fsync 数据和索引后原子地替换检查点文件"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.index_offset = self._flush_index()
+        state = {"offset": self.file.tell(), "count": self.count, "last_id": self.last_id,
+                 "index_offset": self.index_offset}
+        tmp_file = checkpoint_file_for(self.path) + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, checkpoint_file_for(self.path))
+        self._since_checkpoint = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_json_array(path):
+    """文件是否是旧的 JSON 数组格式（第一个非空白字符是 [）"""
+    with open(path, 'rb') as f:
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+    return head == b"["
+
+
+def iter_records(path):
+    """逐条读取记录，兼容 JSONL 和旧的 JSON 数组格式；JSONL 末尾不完整的行被忽略"""
+    with open(path, 'r', encoding='utf-8') as f:
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+        f.seek(0)
+        if head == "[":
+            yield from json.load(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                if line.endswith("\n"):
+                    raise
+                break  # 正在写入或崩溃留下的半行
+
+
+@traced("read")
+def load_records(path):
+    """读取全部记录；同一个 id 被重新计算过时保留最后一条，位置按第一次出现的顺序"""
+    records = {}
+    for record in iter_records(path):
+        records[record["id"]] = record
+    return list(records.values())
+
+
+def fingerprint(*parts):
+    """对一条记录的全部输入（声明、prompt 模板、模型、生成参数、上游记录哈希等）计算指纹"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def record_hash(record):
+    """
+    记录内容的哈希（不含 fingerprint 字段），作为下游记录指纹的一部分。
+    上游记录重新计算后内容没有变化时，下游不需要重新计算。
+    """
+    return fingerprint({key: value for key, value in record.items() if key != "fingerprint"})
+
+
+class RecordIndex:
+    """
+    JSONL 文件中每个 id 最后一条记录的指纹和字节偏移。
+    重新运行时只重新计算指纹变化（或不存在）的记录，其余记录按偏移读取，不需要常驻内存。
+    检查点之前的部分从 RecordWriter 写出的 .idx 索引读取，只解析检查点之后的尾部记录；
+    没有索引的文件（旧输出或合并生成的文件）才从头扫描。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # id -> (fingerprint, offset)
+        self.end = 0  # 最后一个完整行之后的偏移
+        if not os.path.exists(path):
+            return
+        self._load_index()
+        with open(path, 'rb') as f:
+            f.seek(self.end)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # 正在写入或崩溃留下的半行
+                if line.strip():
+                    record = json.loads(line)
+                    self.entries[record["id"]] = (record.get("fingerprint"), self.end)
+                self.end += len(line)
+
+    def _load_index(self):
+        """读取检查点覆盖的 .idx 部分，把 end 移到检查点的偏移"""
+        state = read_checkpoint(self.path)
+        index_file = index_file_for(self.path)
+        if "index_offset" not in state or state["offset"] > os.path.getsize(self.path):
+            return
+        if state["index_offset"] and not os.path.exists(index_file):
+            return
+        entries = {}
+        if state["index_offset"]:
+            with open(index_file, 'rb') as f:
+                for line in f.read(state["index_offset"]).splitlines():
+                    record_id, record_fingerprint, offset = json.loads(line)
+                    entries[record_id] = (record_fingerprint, offset)
+        self.entries = entries
+        self.end = state["offset"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_current(self, record_id, record_fingerprint):
+        """该 id 已有记录且输入指纹一致"""
+        entry = self.entries.get(record_id)
+        return entry is not None and entry[0] == record_fingerprint
+
+    def read(self, record_id):
+        with open(self.path, 'rb') as f:
+            f.seek(self.entries[record_id][1])
+            return json.loads(f.readline())
+
+    def latest_records(self):
+        """按文件顺序逐条读取每个 id 的最后一条记录"""
+        if not self.entries:
+            return
+        with open(self.path, 'rb') as f:
+            for offset in sorted(offset for _, offset in self.entries.values()):
+                f.seek(offset)
+                yield json.loads(f.readline())
+
+    def add(self, record, offset=None):
+        self.entries[record["id"]] = (record.get("fingerprint"), offset)
+
+
+def follow_records(path, poll_interval=1.0, idle_timeout=None, offset=0):
+    """
+    像 tail -f 一样持续读取正在追加写入的 JSONL 文件，只产出已经写完整的行。
+
+    参数：
+        path (str): JSONL 文件，不存在时等待其出现。
+        poll_interval (float): 没有新数据时的轮询间隔（秒）。
+        idle_timeout (float|None): 连续这么久没有新数据就结束；None 表示一直等待，0 表示读到当前末尾即结束。
+        offset (int): 从这个字节偏移开始读取，必须位于行首。
+    """
+    idle_since = time.monotonic()
+    pending = b""
+    f = None
+    try:
+        while True:
+            if f is None and os.path.exists(path):
+                f = open(path, 'rb')
+                f.seek(offset)
+            chunk = f.read() if f is not None else b""
+            if chunk:
+                idle_since = time.monotonic()
+                pending += chunk
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+                continue
+            if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                return
+            time.sleep(poll_interval)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def export_json_array(jsonl_path, json_path):
+    """把 JSONL 导出为原来的 JSON 数组格式（每条记录 indent=2，以逗号分隔），重复的 id 只保留最后一条"""
+    with open(json_path, 'w', encoding='utf-8') as f_out:
+        f_out.write("[\n")
+        for i, record in enumerate(load_records(jsonl_path)):
+            if i > 0:
+                f_out.write(",\n")
+            json.dump(record, f_out, indent=2, ensure_ascii=False)
+        f_out.write("]")
+
+
+if __name__ == "__main__":
+    import sys
+
+    # 导出：python record_io.py export result.jsonl result.json
+    if len(sys.argv) == 4 and sys.argv[1] == "export":
+        export_json_array(sys.argv[2], sys.argv[3])
+        print(f"Exported {sys.argv[2]} to {sys.argv[3]}")
+    else:
+        print("Usage: python record_io.py export <input.jsonl> <output.json>")
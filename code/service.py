@@ -0,0 +1,229 @@
+import json
+import time
+import asyncio
+import argparse
+import functools
+import itertools
+import collections
+import concurrent.futures
+import numpy as np
+from llm_backend import BATCH_SIZE, get_backend
+from program_ir import parse_program
+from Analyze_emo_and_nt import analyze_batch
+from program_execution import execute_record, analysis_inputs, LAZY_EVAL
+from fact_scoring import score_record
+from getlabel import fuse_labels, BAD_EMOTIONS, BAD_NARRATIVE_TECHNIQUES
+from sharded_runner import load_generator
+
+# 凑批的最长等待时间（秒）：第一条请求到达后最多等这么久，或者凑满一个批次就立即处理
+MAX_WAIT = 0.02
+# 用于计算延迟分位数的最近请求数
+LATENCY_WINDOW = 10000
+
+
+def check_claims(claims, ids):
+    """
+    对一批声明依次运行程序生成、情感叙事分析、程序执行和打分，并按 getlabel 的融合规则给出结论。
+
+    返回：
+        list[dict]: 与 claims 一一对应的结论
+    """
+    programs = load_generator().generate_program_batch(list(zip(ids, claims)))
+    analyses = analyze_batch(programs)
+    verdicts = []
+    for program, analysis in zip(programs, analyses):
+        inputs = analysis_inputs(analysis)
+        irs = [parse_program(text) for text in program["predicted_programs"]]
+        result = execute_record(program, irs, inputs, lazy=LAZY_EVAL)
+        score = score_record(result)
+        label = int(fuse_labels(np.array([score["FactScore"]], dtype=np.float64),
+                                np.array([score["Fact_withScore"]], dtype=np.float64),
+                                np.array([score["all_num"]], dtype=np.float64))[0])
+        verdict = {
+            "claim": program["claim"],
+            "label": label,
+            "FactScore": score["FactScore"],
+            "Fact_withScore": score["Fact_withScore"],
+            "all_num": score["all_num"],
+            "emotion": analysis["emotion"],
+            "narrative_techniques": analysis["narrative_techniques"],
+            "potential_propagator": label == 0 and analysis["emotion"] in BAD_EMOTIONS
+                                    and analysis["narrative_techniques"] in BAD_NARRATIVE_TECHNIQUES,
+            "program": program["predicted_programs"][result.get("representative", 0)],
+            "program_error": result.get("program_error"),
+        }
+        if "votes" in result:
+            verdict["votes"] = result["votes"]  # 自洽性采样时各标签的票数
+        verdicts.append(verdict)
+    return verdicts
+
+
+class ClaimCoalescer:
+    """
+    把并发到达的声明合并成批次：第一条到达后最多等待 max_wait 秒，或者凑满 batch_size 条立即处理。
+    相同声明在处理中时不会重复提交，后到的请求直接等待同一个结果。
+    模型调用在单独的线程中串行执行，不阻塞事件循环。check 为处理一批 (claims, ids) 的函数。
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, max_wait=MAX_WAIT, check=check_claims):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.check = check
+        self.pending = []  # [(claim, future)]
+        self.in_flight = {}  # claim -> future
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.ids = itertools.count(1)
+        self.flush_handle = None
+        self.stats = {"requests": 0, "deduplicated": 0, "batches": 0, "batched_claims": 0, "errors": 0}
+
+    async def submit(self, claim):
+        self.stats["requests"] += 1
+        future = self.in_flight.get(claim)
+        if future is not None:
+            self.stats["deduplicated"] += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.in_flight[claim] = future
+        self.pending.append((claim, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self.flush)
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+        if self.pending:
+            # 超出一个批次的请求留给下一批
+            self.flush_handle = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        if batch:
+            asyncio.ensure_future(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        claims = [claim for claim, _ in batch]
+        ids = [next(self.ids) for _ in batch]
+        self.stats["batches"] += 1
+        self.stats["batched_claims"] += len(batch)
+        try:
+            verdicts = await asyncio.get_running_loop().run_in_executor(self.executor, self.check, claims, ids)
+        except Exception as e:
+            self.stats["errors"] += 1
+            verdicts = [e] * len(batch)
+        if len(verdicts) != len(batch):
+            # 结论数与声明数不符时无法对应，整批失败，不让任何请求一直等待
+            self.stats["errors"] += 1
+            verdicts = [RuntimeError(f"check returned {len(verdicts)} verdicts for {len(batch)} claims")] * len(batch)
+        for (claim, future), verdict in zip(batch, verdicts):
+            del self.in_flight[claim]
+            if isinstance(verdict, Exception):
+                future.set_exception(verdict)
+            else:
+                future.set_result(verdict)
+
+
+class FactCheckService:
+    """
+    事实核查 HTTP 服务（仅依赖标准库）：
+        POST /check  {"claim": "..."} -> 结论、得分、情感叙事分析和传播源标记
+        GET  /stats  -> 请求数、合并与去重情况、延迟分位数、后端计数器
+        GET  /health
+    设置 cascade_threshold 时先用基线分类，置信度低于阈值的声明才走完整流程（见 cascade.py）。
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, max_wait=MAX_WAIT, cascade_threshold=None):
+        check = check_claims
+        if cascade_threshold is not None:
+            from cascade import cascade_batch
+            check = functools.partial(cascade_batch, threshold=cascade_threshold)
+        self.coalescer = ClaimCoalescer(batch_size, max_wait, check)
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def latency_percentiles(self):
+        if not self.latencies:
+            return {}
+        values = np.percentile(np.array(self.latencies), [50, 90, 99])
+        return {"p50": float(values[0]), "p90": float(values[1]), "p99": float(values[2]),
+                "max": float(max(self.latencies)), "count": len(self.latencies)}
+
+    def stats(self):
+        stats = dict(self.coalescer.stats)
+        stats["mean_batch_size"] = stats["batched_claims"] / stats["batches"] if stats["batches"] else 0
+        stats["latency_seconds"] = self.latency_percentiles()
+        stats["backend"] = dict(get_backend().stats)
+        return stats
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+        if method == "POST" and path == "/check":
+            try:
+                claim = json.loads(body or b"{}").get("claim")
+            except (json.JSONDecodeError, AttributeError):
+                return 400, {"error": "Request body must be a JSON object"}
+            if not isinstance(claim, str) or not claim.strip():
+                return 400, {"error": "Missing claim"}
+            start = time.perf_counter()
+            try:
+                verdict = await self.coalescer.submit(claim.strip())
+            except Exception as e:
+                return 500, {"error": str(e)}
+            latency = time.perf_counter() - start
+            self.latencies.append(latency)
+            return 200, {**verdict, "latency": latency}
+        return 404, {"error": f"No route for {method} {path}"}
+
+    async def handle(self, reader, writer):
+        """每个连接处理一个请求（Connection: close）"""
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                writer.close()
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            body = await reader.readexactly(length) if length else b""
+            status, payload = await self.route(method, path.split("?", 1)[0], body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {"error": f"Malformed request: {e}"}
+
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port} (batch size {self.coalescer.batch_size}, "
+              f"max wait {self.coalescer.max_wait * 1000:.0f} ms)")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="事实核查 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-wait", type=float, default=MAX_WAIT, help="凑批的最长等待时间（秒）")
+    parser.add_argument("--cascade-threshold", type=float, help="基线置信度低于该值时才走完整流程")
+    args = parser.parse_args()
+
+    asyncio.run(FactCheckService(args.batch_size, args.max_wait, args.cascade_threshold).serve(args.host, args.port))
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import heapq
+import bisect
+import hashlib
+import argparse
+import functools
+import importlib.util
+import multiprocessing
+from record_io import load_records, read_checkpoint, checkpoint_file_for, index_file_for
+
+# 文件路径
+input_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json")
+shard_root = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/shards")  # 各分片的输入、输出和检查点
+output_dir = os.path.join(os.path.dirname(__file__), "/root/LX/Generation")  # 合并后的输出目录
+
+# 流水线各阶段及其输出文件（按执行顺序）
+STAGES = ["generate", "analyze", "execute", "score"]
+STAGE_OUTPUTS = {
+    "generate": "execute_program.jsonl",
+    "analyze": "emotion_narrative_analysis.jsonl",
+    "execute": "result.jsonl",
+    "score": "result_count.jsonl",
+}
+SHARD_INPUT = "weibo.json"
+MANIFEST = "shards.json"
+# 分片耗时超过中位数的这个倍数时标记为落后
+STRAGGLER_RATIO = 1.5
+
+
+@functools.lru_cache(maxsize=None)
+def load_generator():
+    """程序生成脚本的文件名中有空格，只能按路径加载（每个进程只加载一次）"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "v1.0program_generator .py")
+    spec = importlib.util.spec_from_file_location("program_generator", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def assign_shards(ids, num_shards, mode="range"):
+    """
+    把 id 分配到分片，返回与 ids 对应的分片编号。
+
+    range：按 id 排序后切成数量相等的连续区间；hash：按 id 的 sha1 取模，分片更均匀地混合新旧数据。
+    """
+    if mode == "hash":
+        return [int(hashlib.sha1(str(news_id).encode("utf-8")).hexdigest(), 16) % num_shards for news_id in ids]
+    if mode != "range":
+        raise ValueError(f"Unknown shard mode: {mode}")
+    ordered = sorted(ids)
+    # 每个分片的第一个 id 作为区间下界
+    bounds = [ordered[len(ordered) * k // num_shards] for k in range(1, num_shards)] if ordered else []
+    return [bisect.bisect_right(bounds, news_id) for news_id in ids]
+
+
+def split_input(input_file, shard_dirs, mode):
+    """把数据集按分片写到各分片目录；分片方式记录在清单中，续跑时不能改变"""
+    manifest = {"num_shards": len(shard_dirs), "mode": mode}
+    manifest_file = os.path.join(os.path.dirname(shard_dirs[0]), MANIFEST)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise ValueError(f"{manifest_file} was created with {previous}, refusing to reshard with {manifest}")
+
+    with open(input_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    data.sort(key=lambda item: item["id"])  # 各阶段按 id 递增跳过已处理的记录
+    shards = [[] for _ in shard_dirs]
+    for item, shard in zip(data, assign_shards([item["id"] for item in data], len(shard_dirs), mode)):
+        shards[shard].append(item)
+
+    for shard_dir, items in zip(shard_dirs, shards):
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(os.path.join(shard_dir, SHARD_INPUT), 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False)
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return [len(items) for items in shards]
+
+
+def run_stage(stage, shard_dir):
+    """在一个分片目录内运行一个阶段，输入输出都是该目录下的文件"""
+    paths = {name: os.path.join(shard_dir, filename) for name, filename in STAGE_OUTPUTS.items()}
+    if stage == "generate":
+        load_generator().generate_programs(os.path.join(shard_dir, SHARD_INPUT), paths["generate"])
+    elif stage == "analyze":
+        from Analyze_emo_and_nt import analyze_emotion_and_narrative
+        analyze_emotion_and_narrative(paths["generate"], paths["analyze"])
+    elif stage == "execute":
+        from program_execution import execute_programs
+        execute_programs(paths["generate"], paths["analyze"], paths["execute"])
+    elif stage == "score":
+        from fact_scoring import score_results
+        score_results(paths["execute"], paths["score"])
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+
+def run_shard(shard_index, shard_dir, stages, device=None):
+    """
+    工作进程入口：依次运行各阶段，每个进程有自己的后端实例和各自的检查点。
+
+    返回：
+        dict: 每个阶段本次新写出的记录数、耗时和吞吐量
+    """
+    if device is not None:
+        # 必须在第一次 import torch 之前设置
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+
+    stats = {"shard": shard_index, "stages": {}}
+    for stage in stages:
+        output = os.path.join(shard_dir, STAGE_OUTPUTS[stage])
+        before = read_checkpoint(output)["count"]
+        start = time.time()
+        run_stage(stage, shard_dir)
+        elapsed = time.time() - start
+        records = read_checkpoint(output)["count"] - before
+        stats["stages"][stage] = {
+            "records": records,
+            "elapsed": elapsed,
+            "records_per_second": records / elapsed if elapsed > 0 else 0,
+        }
+    stats["elapsed"] = sum(stage["elapsed"] for stage in stats["stages"].values())
+    return stats
+
+
+def merge_outputs(shard_dirs, output_dir, stages):
+    """按 id 归并各分片的输出（每个 id 取最后一条记录），结果与分片数无关"""
+    for stage in stages:
+        filename = STAGE_OUTPUTS[stage]
+        sources = [os.path.join(shard_dir, filename) for shard_dir in shard_dirs]
+        sources = [path for path in sources if os.path.exists(path)]
+        output_file = os.path.join(output_dir, filename)
+        tmp_file = output_file + ".tmp"
+        count = 0
+        with open(tmp_file, 'w', encoding='utf-8') as f_out:
+            shard_records = [sorted(load_records(path), key=lambda record: record["id"]) for path in sources]
+            for record in heapq.merge(*shard_records, key=lambda record: record["id"]):
+                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+        os.replace(tmp_file, output_file)
+        # 合并文件是重新生成的，旧检查点和索引不再对应
+        for stale in (checkpoint_file_for(output_file), index_file_for(output_file)):
+            if os.path.exists(stale):
+                os.remove(stale)
+        print(f"Merged {count} records from {len(sources)} shards into {output_file}")
+
+
+def report_shards(shard_stats, stages):
+    """打印每个分片各阶段的吞吐量，标出落后的分片"""
+    elapsed = sorted(stats["elapsed"] for stats in shard_stats)
+    median = elapsed[len(elapsed) // 2] if elapsed else 0
+    for stats in shard_stats:
+        parts = [f"{stage}: {stats['stages'][stage]['records']} in {stats['stages'][stage]['elapsed']:.1f}s "
+                 f"({stats['stages'][stage]['records_per_second']:.2f}/s)" for stage in stages]
+        straggler = " <- straggler" if median > 0 and stats["elapsed"] > STRAGGLER_RATIO * median else ""
+        print(f"Shard {stats['shard']}: {stats['elapsed']:.1f}s | " + " | ".join(parts) + straggler)
+
+
+def run_sharded(input_file, shard_root, output_dir, num_workers, stages=STAGES, mode="range", devices=None):
+    """
+    把声明按 id 分片交给 num_workers 个进程并行处理，完成后按 id 合并各阶段输出。
+    中断后重新运行会从各分片自己的检查点继续。
+    """
+    shard_dirs = [os.path.join(shard_root, f"shard_{k:03d}") for k in range(num_workers)]
+    sizes = split_input(input_file, shard_dirs, mode)
+    print(f"Split {sum(sizes)} claims into {num_workers} shards by {mode}: {sizes}")
+
+    # spawn 启动的子进程不继承父进程的模型和 CUDA 状态
+    context = multiprocessing.get_context("spawn")
+    start = time.time()
+    with context.Pool(num_workers) as pool:
+        shard_stats = pool.starmap(run_shard, [
+            (k, shard_dir, stages, devices[k % len(devices)] if devices else None)
+            for k, shard_dir in enumerate(shard_dirs)
+        ])
+    elapsed = time.time() - start
+
+    report_shards(shard_stats, stages)
+    merge_outputs(shard_dirs, output_dir, stages)
+
+    records = sum(stats["stages"][stages[0]]["records"] for stats in shard_stats) if stages else 0
+    print(f"Processed {records} claims with {num_workers} workers in {elapsed:.1f}s "
+          f"({records / elapsed if elapsed > 0 else 0:.2f} claims/s)")
+    with open(os.path.join(shard_root, "shard_stats.json"), 'w', encoding='utf-8') as f:
+        json.dump({"elapsed": elapsed, "shards": shard_stats}, f, indent=2)
+    return shard_stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="按 id 分片的多进程流水线")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--shard-by", choices=["range", "hash"], default="range")
+    parser.add_argument("--devices", nargs="+", help="分配给各工作进程的 GPU 编号（轮流分配）")
+    parser.add_argument("--input", default=input_file)
+    parser.add_argument("--shard-root", default=shard_root)
+    parser.add_argument("--output-dir", default=output_dir)
+    args = parser.parse_args()
+
+    run_sharded(args.input, args.shard_root, args.output_dir, args.workers, args.stages, args.shard_by, args.devices)
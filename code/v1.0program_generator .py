@@ -1,19 +1,21 @@
 import os
 import json
-import re
-from transformers import AutoTokenizer, AutoModel
-
-# 设置模型和分词器路径
-MODEL_PATH = os.environ.get('MODEL_PATH', '/root/autodl-tmp/glm-4-9b-chat')
-TOKENIZER_PATH = os.environ.get("TOKENIZER_PATH", MODEL_PATH)
-
-# 加载分词器和模型
-tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, trust_remote_code=True)
-model = AutoModel.from_pretrained(MODEL_PATH, trust_remote_code=True, device_map="auto").eval()
+import time
+import argparse
+from llm_backend import get_backend, BATCH_SIZE
+from record_io import RecordWriter, RecordIndex, fingerprint
+from claim_store import iter_claims, render_prompt
+from instrumentation import traced
+from program_ir import canonical_program
+
+# 逐步批处理：一条程序生成结束后立即由下一条声明补上空位（见 continuous_batching.py）
+CONTINUOUS_BATCHING = os.environ.get("CONTINUOUS_BATCHING", "0") == "1"
+# 自洽性采样：每条声明采样的程序数，大于 1 时去重后的程序一起执行并多数投票（见 program_execution.py）
+SELF_CONSISTENCY_SAMPLES = int(os.environ.get("SELF_CONSISTENCY_SAMPLES", "1"))
 
 # 文件路径
 input_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/weibo.json")
-output_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/execute_program.json")
+output_file = os.path.join(os.path.dirname(__file__), "/root/LX/Generation/execute_program.jsonl")
 
 # Prompt 模板
 prompt_template = '''
@@ -61,103 +63,177 @@ def program():
 '''
 
 
-def get_last_processed_id(output_file):
-    """
-    尝试读取 output_file 中最后一个合法的 ID。
+# few-shot 示例部分对所有声明都相同，只有 [[CLAIM]] 所在的结尾随声明变化：
+# 前缀的 KV 缓存只计算一次，之后每条声明只预填充后缀
+CLAIM_SUFFIX_START = prompt_template.index("The claim is that [[CLAIM]]")
+prompt_prefix = prompt_template[:CLAIM_SUFFIX_START]
+prompt_suffix_template = prompt_template[CLAIM_SUFFIX_START:]
 
-    参数：
-        output_file (str): 文件路径。
 
-    返回：
-        int: 最大的 ID，若未找到合法数据返回 None。
-    """
-    try:
-        with open(output_file, 'r', encoding='utf-8') as file:
-            max_id = 0
-            id_pattern = re.compile(r'"id"\s*:\s*(\d+)')
-
-            for line in file:
-                matches = id_pattern.findall(line)
-                for match in matches:
-                    num = int(match)
-                    if max_id is None or num > max_id:
-                        max_id = num
-            print(max_id)
-            return max_id
-    except FileNotFoundError:
-        print(f"文件 {output_file} 未找到。")
-    except Exception as e:
-        print(f"发生错误: {e}")
-
-    return 0
-
-
-def create_result(news_id, claim, program):
-    """格式化结果"""
-    return {
+# 生成参数（同时计入记录指纹）
+GENERATION_PARAMS = {"max_new_tokens": 256, "do_sample": True, "temperature": 0.5, "max_length": 1024, "stop": ["#end"]}
+
+
+def program_fingerprint(claim):
+    """生成结果的输入指纹：声明、prompt 模板、模型、生成参数和采样数（只采样一个程序时与之前相同）"""
+    samples = [SELF_CONSISTENCY_SAMPLES] if SELF_CONSISTENCY_SAMPLES > 1 else []
+    return fingerprint(claim, prompt_template, get_backend().model_id, GENERATION_PARAMS, *samples)
+
+
+def create_result(news_id, claim, programs, weights=None):
+    """格式化结果；weights 为每个去重后的程序被采样到的次数"""
+    result = {
         'id': news_id,
         'claim': claim,
-        'predicted_programs': [program]
+        'predicted_programs': programs,
+        'fingerprint': program_fingerprint(claim)
     }
+    if weights is not None:
+        result['program_weights'] = weights
+    return result
+
+
+def sampled_result(news_id, claim, generated_texts):
+    """由一条声明的一个或多个生成结果得到记录：多个采样程序按规范形式去重，按采样次数从多到少排列"""
+    programs = [extract_program(generated) for generated in generated_texts]
+    if len(programs) == 1:
+        return create_result(news_id, claim, programs)
+    groups = {}  # 规范形式 -> [第一次出现的程序文本, 次数]
+    for program in programs:
+        group = groups.setdefault(canonical_program(program), [program, 0])
+        group[1] += 1
+    ranked = sorted(groups.values(), key=lambda group: -group[1])  # 稳定排序，票数相同时保持采样顺序
+    return create_result(news_id, claim, [program for program, _ in ranked], [count for _, count in ranked])
+
+def extract_program(generated):
+    """从模型续写的文本中截取程序部分"""
+    program = ("def program():\n" + generated).strip()
+    end_marker = "#end"
+    program_end = program.find(end_marker)
+    if program_end != -1:
+        program = program[:program_end + len(end_marker)].strip()
+    return program
+
+
+@traced("generate", lambda batch: [news_id for news_id, _ in batch])
+def generate_program_batch(batch):
+    """对一批 (news_id, claim) 批量生成程序，返回结果记录"""
+    # 替换 Prompt 中的 [[CLAIM]]
+    suffixes = [render_prompt(prompt_suffix_template, {'[CLAIM]': claim}) for _, claim in batch]
+
+    # 模型生成（prompt 以 def program(): 结尾，返回的是续写部分），复用固定前缀的 KV 缓存
+    # 生成出 #end 后立即停止，不再为之后会被丢弃的内容解码
+    # 自洽性采样时每条声明的 K 个程序在同一次调用中生成，声明部分也只预填充一次
+    samples = SELF_CONSISTENCY_SAMPLES
+    outputs = get_backend().generate_with_prefix(prompt_prefix, suffixes, num_return_sequences=samples,
+                                                 **GENERATION_PARAMS)
+
+    return [sampled_result(news_id, claim, outputs[k * samples:(k + 1) * samples])
+            for k, (news_id, claim) in enumerate(batch)]
+
+
+def write_program_batch(batch, writer):
+    """对一批声明批量生成程序并写入文件"""
+    for result in generate_program_batch(batch):
+        # 写入结果
+        writer.write(result)
+
+        print(f"Processed claim {result['id']}: {result['claim']}")
+
+
+@traced("generate")
+def write_programs_continuous(claims, writer):
+    """
+    用逐步批处理生成程序，每条声明的程序全部生成结束后立即写入文件（写入顺序与完成顺序一致）。
+    自洽性采样时每个采样程序作为一条单独的序列加入批次。
+    """
+    from continuous_batching import ContinuousBatcher, print_report
 
-def generate_programs(input_file, output_file):
-    """逐条生成程序并写入文件"""
-    last_processed_id = get_last_processed_id(output_file)
-    print(f"Last processed ID: {last_processed_id}")
-
-    # 打开输出文件，以追加模式写入
-    with open(output_file, 'a', encoding='utf-8') as f_out:
-        if last_processed_id == 0:
-            f_out.write("[\n")  # 如果文件为空，写入 JSON 数组的起始符号
-
-        # 读取输入文件
-        with open(input_file, 'r', encoding='utf-8') as f_in:
-            data = json.load(f_in)
-
-        news_id = last_processed_id + 1  # 从上次的 ID + 1 开始
-        for index, item in enumerate(data):
-            if index + 1 <= last_processed_id:  # 跳过已处理的记录
-                continue
-
-            claim = item.get("Claim")
-            if not claim:
-                print(f"Skipping item {news_id}: Missing claim.")
-                continue
-
-            # 替换 Prompt 中的 [[CLAIM]]
-            prompt = prompt_template.replace('[CLAIM]', claim)
-
-            # 模型生成
-            device = model.device
-            inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=1024).to(device)
-            outputs = model.generate(**inputs, max_new_tokens=256, do_sample=True, temperature=0.5)
-            full_output = tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-            # 提取程序部分
-            start_marker = "and end the program() with #end."
-            program_start = full_output.find(start_marker)
-            if program_start != -1:
-                program_start += len(start_marker)
-                program = full_output[program_start:].strip()
-                end_marker = "#end"
-                program_end = program.find(end_marker)
-                if program_end != -1:
-                    program = program[:program_end + len(end_marker)].strip()
-            else:
-                program = "Invalid output: Start marker not found."
-
-            # 写入结果
-            result = create_result(news_id, claim, program)
-            json.dump(result, f_out, indent=2, ensure_ascii=False)
-            f_out.write(",\n")  # 每条记录以逗号分隔
+    finished = {}  # (news_id, claim) -> 已生成的采样程序
 
+    def on_finish(key, generated):
+        news_id, claim, _ = key
+        outputs = finished.setdefault((news_id, claim), [])
+        outputs.append(generated)
+        if len(outputs) == SELF_CONSISTENCY_SAMPLES:
+            del finished[(news_id, claim)]
+            writer.write(sampled_result(news_id, claim, outputs))
             print(f"Processed claim {news_id}: {claim}")
-            news_id += 1
 
-        f_out.write("]")  # JSON 数组结束符号
+    def sequences():
+        for news_id, claim in claims:
+            suffix = render_prompt(prompt_suffix_template, {'[CLAIM]': claim})
+            for sample in range(SELF_CONSISTENCY_SAMPLES):
+                yield (news_id, claim, sample), suffix
 
+    batcher = ContinuousBatcher(prompt_prefix, BATCH_SIZE, **GENERATION_PARAMS)
+    batcher.run(sequences(), on_finish)
+    print_report(batcher.report)
+
+
+def generate_programs(input_file, output_file):
+    """逐条生成程序并写入文件，只为没有结果或输入指纹已变化的声明重新生成"""
+    # 打开输出文件，以追加模式写入 JSONL；重新生成的记录追加在后面，读取时以最后一条为准
+    with RecordWriter(output_file) as writer:
+        index = RecordIndex(output_file)
+        print(f"Existing records: {len(index)}")
+
+        # 读取输入文件（有预处理的声明存储时直接从存储读取）
+        data = iter_claims(input_file)
+
+        def claims_to_generate():
+            for item in data:
+                news_id = item["id"]
+                claim = item.get("Claim")
+                if not claim:
+                    print(f"Skipping item {news_id}: Missing claim.")
+                    continue
+                if index.is_current(news_id, program_fingerprint(claim)):  # 跳过输入没有变化的记录
+                    continue
+                yield news_id, claim
+
+        if CONTINUOUS_BATCHING:
+            write_programs_continuous(claims_to_generate(), writer)
+            return
+
+        pending = []  # 等待批量生成的 (news_id, claim)
+        for news_id, claim in claims_to_generate():
+            pending.append((news_id, claim))
+            if len(pending) >= BATCH_SIZE:
+                write_program_batch(pending, writer)
+                pending = []
+
+        if pending:
+            write_program_batch(pending, writer)
+
+
+def benchmark_prefix_cache(input_file, limit=20):
+    """对前 limit 条声明生成程序，统计复用前缀 KV 缓存后每条声明节省的预填充 token"""
+    with open(input_file, 'r', encoding='utf-8') as f_in:
+        claims = [item["Claim"] for item in json.load(f_in)[:limit] if item.get("Claim")]
+
+    backend = get_backend()
+    before = dict(backend.stats)
+    start = time.time()
+    suffixes = [prompt_suffix_template.replace('[CLAIM]', claim) for claim in claims]
+    backend.generate_with_prefix(prompt_prefix, suffixes, **GENERATION_PARAMS)
+    elapsed = time.time() - start
+
+    prompt_tokens = backend.stats["prompt_tokens"] - before["prompt_tokens"]
+    prefill_tokens = backend.stats["prefill_tokens"] - before["prefill_tokens"]
+    print(f"Claims: {len(claims)}, elapsed: {elapsed:.2f}s")
+    print(f"Prompt tokens per claim: {prompt_tokens / len(claims):.1f}")
+    print(f"Prefill tokens per claim: {prefill_tokens / len(claims):.1f}")
+    print(f"Prefill tokens saved per claim: {(prompt_tokens - prefill_tokens) / len(claims):.1f} "
+          f"({1 - prefill_tokens / prompt_tokens:.1%})")
 
 
 # 调用函数生成程序
 if __name__ == "__main__":
-    generate_programs(input_file, output_file)
+    parser = argparse.ArgumentParser(description="生成推理程序")
+    parser.add_argument("--benchmark", type=int, metavar="N", help="只对前 N 条声明测试前缀缓存节省的预填充 token")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_prefix_cache(input_file, args.benchmark)
+    else:
+        generate_programs(input_file, output_file)